@@ -0,0 +1,113 @@
+"""NodeListScanner 基准测试：在生成的订阅响应体上对比逐块扫描与整体解码后匹配的耗时和内存峰值
+
+用法（在仓库根目录）：python benchmarks/bench_node_list_scanner.py [--repeat N]
+"""
+import argparse
+import base64
+import io
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import subscription_bot as sb  # noqa: E402
+
+INFO = ["upload=1073741824", "download=5368709120", "total=107374182400", "expire=1767196800"]
+
+
+def ss_nodes(count):
+    return [f"ss://{base64.b64encode(b'aes-256-gcm:pw%d' % i).decode()}@1.2.3.{i % 250}:{10000 + i}"
+            f"#%F0%9F%87%AD%F0%9F%87%B0%20HK%20{i:05d}" for i in range(count)]
+
+
+def vmess_nodes(count):
+    return ["vmess://" + base64.b64encode(
+        ('{"v":"2","ps":"JP %05d","add":"jp%d.example.com","port":"443","id":"%032x","aid":"0",'
+         '"net":"ws","path":"/ray","tls":"tls"}' % (i, i, i * 2654435761)).encode()).decode()
+            for i in range(count)]
+
+
+def b64(lines, wrap=False, urlsafe=False, pad=True):
+    data = base64.b64encode("\n".join(lines).encode())
+    if urlsafe:
+        data = data.translate(bytes.maketrans(b'+/', b'-_'))
+    if not pad:
+        data = data.rstrip(b'=')
+    if wrap:
+        data = b"\r\n".join(data[i:i + 76] for i in range(0, len(data), 76))
+    return data
+
+
+CORPUS = {
+    "信息在前 20k ss (base64)": b64(INFO + ss_nodes(20000)),
+    "信息在后 20k vmess (base64)": b64(vmess_nodes(20000) + INFO),
+    "无信息 20k vmess (base64)": b64(vmess_nodes(20000)),
+    "单行信息 + 5k ss (明文)": ("upload=1; download=2; total=3; expire=4\n" + "\n".join(ss_nodes(5000))).encode(),
+    "冒号写法，URL 安全、换行、无填充": b64(["UPLOAD: 11", "Download: 22", "total:33", "expire :44"] + ss_nodes(3000),
+                                 wrap=True, urlsafe=True, pad=False),
+    "总流量 + 日期 (base64)": b64(["总流量：500", "Expire: 2025-01-01"] + ss_nodes(2000)),
+    "只有流量字段 (明文)": b"upload=1024\ndownload=2048\ntotal=107374182400\n",
+}
+
+WHOLE_PATTERN = re.compile(r'(upload|download|total|expire)[ \t]*[=:][ \t]*(\d+)(?![\d.:/-])', re.IGNORECASE)
+
+
+def response(body):
+    res = requests.Response()
+    res.status_code = 200
+    res.raw = io.BytesIO(body)
+    res.headers['Content-Length'] = str(len(body))
+    return res
+
+
+def run_scanner(body):
+    scanner = sb.NodeListScanner()
+    sb.scan_body(response(body), scanner, sb.TransferStats())
+    return scanner.info
+
+
+def run_whole(body):
+    """对照组：读完整个响应体，尝试整体 base64 解码后用正则匹配"""
+    text = response(body).content
+    try:
+        text = base64.b64decode(text.translate(sb.BASE64_URLSAFE_TABLE, b' \t\r\n') + b'==')
+    except ValueError:
+        pass
+    info = {}
+    for key, value in WHOLE_PATTERN.findall(text.decode('utf-8', errors='replace')):
+        info.setdefault(key.lower(), int(value))
+    return info
+
+
+def measure(func, body, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(body)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    func(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='每项测量重复次数，取最快的一次')
+    args = parser.parse_args()
+
+    print(f"{'响应体':<32}{'大小':>10}{'逐块 ms':>10}{'整体 ms':>10}{'逐块峰值':>12}{'整体峰值':>12}  结果")
+    for name, body in CORPUS.items():
+        scan_time, scan_peak = measure(run_scanner, body, args.repeat)
+        whole_time, whole_peak = measure(run_whole, body, args.repeat)
+        print(f"{name:<32}{len(body) // 1024:>8}KB{scan_time * 1000:>10.1f}{whole_time * 1000:>10.1f}"
+              f"{scan_peak // 1024:>10}KB{whole_peak // 1024:>10}KB  {run_scanner(body)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# 使 pytest 能直接导入仓库根目录下的 subscription_bot
@@ -1,3 +1,6 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # 用于统计启动耗时
+
 import logging
 import json
 import os
@@ -5,33 +8,44 @@ from datetime import datetime, time as dtime
 from zoneinfo import ZoneInfo
 import asyncio
 import requests
-from telegram import Update
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, NetworkError, TelegramError
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes
+    Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
 )
 import base64
+import binascii
 import re
-import time
-import subprocess
-import sys
-from bs4 import BeautifulSoup
-from urllib.parse import unquote, urlparse, parse_qs
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('subscription_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+import threading
+import random
+import socket
+import secrets
+import sqlite3
+import csv
+import io
+import heapq
+import html
+from urllib.parse import unquote, urlparse, parse_qs, urljoin
 
 # 配置文件
 CONFIG_FILE = "config.json"
-SUBSCRIPTIONS_FILE = "subscriptions.json"
+SUBSCRIPTIONS_FILE = "subscriptions.json"  # 旧版存储，首次启动时导入数据库
 TIMEZONE = ZoneInfo("Asia/Shanghai")
 
+def setup_logging():
+    """配置日志，由 main() 在启动时调用，导入模块时不创建日志文件"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('subscription_bot.log', encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+
 # ------------------ 配置管理 ------------------
 def load_config():
     if os.path.exists(CONFIG_FILE):
@@ -43,370 +57,1875 @@ def save_config(config):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
 
-# 加载配置
-config = load_config()
-BOT_TOKEN = config["bot_token"]
-CHAT_IDS = config.get("chat_ids", [])  # 改为列表存储多个群组ID
-CHECK_HOUR = config.get("check_hour", 9)
-ADMIN_ID = config.get("admin_id")
+# 固定参数
+FETCH_BACKOFF_MAX = 10  # 单次重试退避的最长秒数
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+PERMANENT_REDIRECT_CODES = {301, 308}
+PROBE_DRAIN_LIMIT = 16 * 1024  # 小于此大小的响应体直接读完，以便连接放回连接池复用
+BURN_RATE_DAYS = 7  # 计算日均消耗时使用最近几天的数据
+SCHEDULE_TICK = 30  # 调度器检查到期任务的周期（秒），命令修改的订阅最迟在一个周期后生效
+SCHEDULE_JITTER = 0.1  # 检查间隔的随机抖动比例，避免所有订阅在同一时刻检查
+SEND_CHAT_RATE = 1  # 单个私聊每秒最多发送的消息数
+SEND_GROUP_RATE = 20 / 60  # 单个群组每秒最多发送的消息数（Telegram 限制 20 条/分钟）
+SEND_CHAT_BURST = 3  # 单个聊天允许的突发消息数
+DELETE_DELAY = 60  # 机器人消息自动删除的延迟（秒）
+DELETE_TICK = 5  # 删除队列的处理周期（秒）
+DELETE_RETRIES = 6  # 被限流或网络错误导致删除失败时，放回队列重试的次数
+DELETE_BACKOFF_MAX = 600  # 删除重试退避的最长秒数（消息超过 48 小时后无法删除）
+UPDATE_BACKLOG = 1024  # 同时进入处理器（包括按顺序等待）的更新数量上限
+DEFAULT_COMMAND_LIMITS = {"check": 2, "import": 1, "sub": 4}  # 耗时命令各自的并发上限
+NAME_CACHE_TTL = 7 * 86400  # 机场名按主机缓存的有效期（秒），面板名称很少变化
+NAME_RETRY_TTL = 600  # 未能解析出机场名时，多久之后再重新请求（秒）
+TITLE_READ_LIMIT = 64 * 1024  # 读取面板页面查找 <title> 的最大字节数
+
+# 配置参数，由 apply_config() 在启动时根据配置文件设置
+config = {}
+
+def apply_config(cfg: dict):
+    """根据配置设置模块级参数，启动时在创建任何全局对象之前调用"""
+    global config, BOT_TOKEN, CHAT_IDS, CHECK_HOUR, ADMIN_ID, SUBSCRIPTIONS_DB, FETCH_CONCURRENCY
+    global FETCH_TIMEOUT, CHECK_DEADLINE, FETCH_RETRIES, FETCH_BACKOFF, MAX_REDIRECTS, PROBE_HEAD
+    global CACHE_TTL, CACHE_MAX_ENTRIES, HTTP_POOL_HOSTS, HTTP_POOL_PER_HOST, DNS_CACHE_TTL
+    global PROGRESS_EDIT_INTERVAL, IO_WORKERS, HISTORY_RAW_DAYS, HISTORY_DAYS, ALERT_REMAINING_GB
+    global ALERT_EXPIRE_DAYS, ALERT_COOLDOWN_HOURS, ALERT_TARGET, SCHEDULE_ENABLED, SCHEDULE_BASE_MINUTES
+    global SCHEDULE_MIN_MINUTES, SCHEDULE_MAX_MINUTES, SEND_CONCURRENCY, SEND_RATE, SEND_RETRIES
+    global WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+    global UPDATE_WORKERS, COMMAND_LIMITS, PANEL_NAMES
+    config = cfg
+    BOT_TOKEN = cfg["bot_token"]
+    CHAT_IDS = cfg.get("chat_ids", [])  # 改为列表存储多个群组ID
+    CHECK_HOUR = cfg.get("check_hour", 9)
+    ADMIN_ID = cfg.get("admin_id")
+    SUBSCRIPTIONS_DB = cfg.get("subscriptions_db", "subscriptions.db")
+    FETCH_CONCURRENCY = cfg.get("fetch_concurrency", 20)  # 同时检查的订阅数量上限
+    FETCH_TIMEOUT = cfg.get("fetch_timeout", 5)  # 单个请求超时（秒）
+    CHECK_DEADLINE = cfg.get("check_deadline", 120)  # 一次完整检查的总时限（秒）
+    FETCH_RETRIES = cfg.get("fetch_retries", 2)  # 连接失败、超时或 429/5xx 时的重试次数
+    FETCH_BACKOFF = cfg.get("fetch_backoff", 0.5)  # 重试退避的基准秒数，每次重试翻倍并加随机抖动
+    MAX_REDIRECTS = cfg.get("max_redirects", 5)  # 单次请求允许的最大重定向次数
+    PROBE_HEAD = cfg.get("probe_head", False)  # 探测时是否先发送 HEAD 请求
+    CACHE_TTL = cfg.get("cache_ttl", 300)  # 订阅流量信息缓存有效期（秒）
+    CACHE_MAX_ENTRIES = cfg.get("cache_max_entries", 1024)  # 缓存的最大订阅数量
+    HTTP_POOL_HOSTS = cfg.get("http_pool_hosts", 100)  # 保持连接池的主机数量上限
+    HTTP_POOL_PER_HOST = cfg.get("http_pool_per_host", FETCH_CONCURRENCY)  # 每个主机保持的空闲连接数上限，默认与并发上限一致
+    DNS_CACHE_TTL = cfg.get("dns_cache_ttl", 300)  # DNS 解析结果缓存时间（秒），0 表示不缓存
+    PROGRESS_EDIT_INTERVAL = cfg.get("progress_edit_interval", 3)  # /check 进度消息两次编辑的最小间隔（秒）
+    IO_WORKERS = cfg.get("io_workers", 32)  # 阻塞网络请求线程池大小，应大于 fetch_concurrency 以给交互命令留出余量
+    HISTORY_RAW_DAYS = cfg.get("history_raw_days", 30)  # 按小时保存的流量历史保留天数
+    HISTORY_DAYS = cfg.get("history_days", 400)  # 按天降采样的流量历史保留天数
+    ALERT_REMAINING_GB = cfg.get("alert_remaining_gb", 10)  # 剩余流量低于此值（GB）时告警，0 表示不告警
+    ALERT_EXPIRE_DAYS = cfg.get("alert_expire_days", 3)  # 距到期不足此天数时告警，0 表示不告警
+    ALERT_COOLDOWN_HOURS = cfg.get("alert_cooldown_hours", 24)  # 同一告警持续存在时重复提醒的间隔（小时）
+    ALERT_TARGET = cfg.get("alert_target", "admin")  # 告警发送目标：admin 发给管理员，groups 发到 chat_ids 中的群组
+    SCHEDULE_ENABLED = cfg.get("schedule_enabled", True)  # 是否在后台按订阅状态自适应地检查每个订阅
+    SCHEDULE_BASE_MINUTES = cfg.get("schedule_base_minutes", 360)  # 自适应检查的基准间隔（分钟）
+    SCHEDULE_MIN_MINUTES = cfg.get("schedule_min_minutes", 30)  # 流量将用完或即将到期时的最短间隔（分钟）
+    SCHEDULE_MAX_MINUTES = cfg.get("schedule_max_minutes", 1440)  # 状态良好或链接失效时退避的最长间隔（分钟）
+    SEND_CONCURRENCY = cfg.get("send_concurrency", 8)  # 同时进行的 Telegram 发送请求数量上限
+    SEND_RATE = cfg.get("send_rate", 25)  # 全局每秒最多发送的消息数（Telegram 限制约 30 条/秒）
+    SEND_RETRIES = cfg.get("send_retries", 3)  # 被限流或网络错误时的重试次数
+    WEBHOOK_URL = cfg.get("webhook_url", "")  # 设置后使用 webhook 模式接收消息，为 Telegram 可访问的 https 地址
+    WEBHOOK_LISTEN = cfg.get("webhook_listen", "0.0.0.0")  # webhook 内置 HTTP 服务监听的地址
+    WEBHOOK_PORT = cfg.get("webhook_port", 8443)  # webhook 内置 HTTP 服务监听的端口
+    WEBHOOK_SECRET = cfg.get("webhook_secret", "")  # 校验请求头 X-Telegram-Bot-Api-Secret-Token，留空则每次启动随机生成
+    WEBHOOK_MAX_CONNECTIONS = cfg.get("webhook_max_connections", 40)  # Telegram 同时推送更新的最大连接数（1-100）
+    # 同时处理的更新数量上限，兼容旧配置项 webhook_workers
+    UPDATE_WORKERS = cfg.get("update_workers", cfg.get("webhook_workers", 16))
+    COMMAND_LIMITS = {**DEFAULT_COMMAND_LIMITS, **cfg.get("command_limits", {})}  # 耗时命令各自的并发上限
+    # 已知面板的 主机名 -> 机场名，命中时 /sub 不再请求面板页面
+    PANEL_NAMES = {host.lower(): name for host, name in cfg.get("panel_names", {}).items()}
+
+# ------------------ 数据记录 ------------------
+def format_date(ts: float, fmt: str = '%Y-%m-%d') -> str:
+    """按 TIMEZONE 格式化时间戳，所有展示的日期都经由此处，不受服务器时区影响"""
+    return datetime.fromtimestamp(ts, TIMEZONE).strftime(fmt)
+
+class Subscription:
+    """订阅记录"""
+    __slots__ = ('id', 'name', 'url', 'custom_message')
+
+    def __init__(self, sub_id, name: str, url: str, custom_message: str = ""):
+        self.id = sub_id
+        self.name = name
+        self.url = url
+        self.custom_message = custom_message
+
+class TrafficInfo:
+    """订阅流量信息：保存原始字节数和到期时间戳（秒），只在展示时格式化"""
+    __slots__ = ('upload', 'download', 'total', 'expire')
+
+    def __init__(self, upload: int = 0, download: int = 0, total: int = 0, expire: int = None):
+        self.upload = upload
+        self.download = download
+        self.total = total
+        self.expire = expire or None  # 0 或缺失表示到期时间未知
+
+    @property
+    def used(self) -> int:
+        return self.upload + self.download
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.used
+
+    def expire_date(self) -> str:
+        return format_date(self.expire) if self.expire else "未知"
+
+    @classmethod
+    def from_header(cls, userinfo: str) -> 'TrafficInfo':
+        """解析 subscription-userinfo 头，如 upload=1; download=2; total=3; expire=4
+
+        不带键名时按 上传、下载、总量、到期 的顺序取数字；无法解析时抛出 ValueError。
+        """
+        values = {}
+        for item in userinfo.split(';'):
+            key, sep, value = item.partition('=')
+            if sep and value.strip():
+                values[key.strip().lower()] = int(float(value.strip()))
+        if not values:
+            numbers = [int(n) for n in re.findall(r'\d+', userinfo)]
+            values = dict(zip(('upload', 'download', 'total', 'expire'), numbers))
+        if 'total' not in values:
+            raise ValueError(f"无法解析流量信息: {userinfo}")
+        return cls(values.get('upload', 0), values.get('download', 0), values['total'], values.get('expire'))
+
+# ------------------ 并发抓取 ------------------
+CLASH_HEADERS = {
+    'User-Agent': 'ClashforWindows/0.18.1'
+}
+
+class KeepAliveAdapter(HTTPAdapter):
+    """为连接池中的连接开启 TCP keep-alive，避免空闲连接被中间设备静默断开"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)):
+            if hasattr(socket, name):
+                socket_options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+def create_http_session() -> requests.Session:
+    """创建全进程共享的会话：按主机复用连接并保持长连接"""
+    session = requests.Session()
+    adapter = KeepAliveAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_PER_HOST)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_resolve_uncached = socket.getaddrinfo
+_dns_cache = OrderedDict()
+_dns_lock = threading.Lock()
+
+def _getaddrinfo_cached(*args, **kwargs):
+    """带 TTL 的 getaddrinfo，只缓存解析成功的结果"""
+    key = (args, tuple(sorted(kwargs.items())))
+    now = time.time()
+    with _dns_lock:
+        cached = _dns_cache.get(key)
+        if cached is not None and cached[0] > now:
+            _dns_cache.move_to_end(key)
+            return cached[1]
+    result = _resolve_uncached(*args, **kwargs)
+    with _dns_lock:
+        _dns_cache[key] = (now + DNS_CACHE_TTL, result)
+        _dns_cache.move_to_end(key)
+        while len(_dns_cache) > 1024:
+            _dns_cache.popitem(last=False)
+    return result
+
+class IOExecutor:
+    """有界线程池：在事件循环之外执行阻塞的网络请求，并统计排队和执行中的任务数"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='io')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def run(self, func, *args):
+        """在线程池中执行 func(*args) 并等待结果"""
+        state = {'dequeued': False}
+
+        def dequeue():
+            # 开始执行或被取消时，只由先到的一方将任务移出队列
+            with self._lock:
+                if not state['dequeued']:
+                    state['dequeued'] = True
+                    self.queued -= 1
+
+        def call():
+            dequeue()
+            with self._lock:
+                self.in_flight += 1
+            try:
+                return func(*args)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+
+        with self._lock:
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            if self.queued == self.max_workers:
+                logging.warning(f"网络请求线程池已饱和，排队任务数: {self.queued}")
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            dequeue()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'peak_queued': self.peak_queued,
+                'completed': self.completed,
+                'failed': self.failed
+            }
+
+# 以下全局对象依赖配置，由 init_services() 在启动时创建
+http_session = None
+io_executor = None
+
+class TransferStats:
+    """统计订阅请求的传输字节数，用于衡量只取响应头带来的节省"""
+
+    def __init__(self, parent: 'TransferStats' = None):
+        self.parent = parent
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.header_only = 0  # 仅凭响应头即完成的请求数
+        self.bytes_received = 0  # 实际下载的响应体字节数
+        self.bytes_skipped = 0  # 提前关闭而未下载的响应体字节数（按 Content-Length 估算）
+
+    def record(self, received: int = 0, skipped: int = 0, header_only: bool = False, request: bool = False):
+        with self._lock:
+            self.requests += int(request)
+            self.header_only += int(header_only)
+            self.bytes_received += received
+            self.bytes_skipped += skipped
+        if self.parent is not None:
+            self.parent.record(received, skipped, header_only, request)
+
+    def summary(self) -> str:
+        return (f"请求 {self.requests} 次，{self.header_only} 次仅取响应头，"
+                f"下载 {self.bytes_received} 字节，跳过 {self.bytes_skipped} 字节")
+
+transfer_stats = TransferStats()
+
+def http_request(session: requests.Session, method: str, url: str, retries: int = None, **kwargs) -> requests.Response:
+    """按统一的超时与重试策略发送请求
+
+    连接错误、超时以及 429/5xx 响应按指数退避加随机抖动重试，
+    429 响应的 Retry-After 作为退避下限；重试用尽后返回最后一次响应或抛出异常。
+    """
+    kwargs.setdefault('timeout', FETCH_TIMEOUT)
+    if retries is None:
+        retries = FETCH_RETRIES
+    for attempt in range(retries + 1):
+        retry_after = 0
+        try:
+            res = session.request(method, url, **kwargs)
+            if res.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return res
+            if res.headers.get('Retry-After', '').isdigit():
+                retry_after = int(res.headers['Retry-After'])
+            res.close()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == retries:
+                raise
+        delay = random.uniform(0, min(FETCH_BACKOFF_MAX, FETCH_BACKOFF * 2 ** attempt))
+        time.sleep(min(FETCH_BACKOFF_MAX, max(delay, retry_after)))
+
+class RedirectCache:
+    """记住永久重定向（301/308）的目标，之后的请求直接从最终链接开始"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._targets = OrderedDict()
+
+    def resolve(self, url: str) -> str:
+        """沿缓存的永久重定向链找到最终链接，最多 MAX_REDIRECTS 跳，遇到循环即停止"""
+        seen = {url}
+        with self._lock:
+            for _ in range(MAX_REDIRECTS):
+                target = self._targets.get(url)
+                if target is None or target in seen:
+                    break
+                self._targets.move_to_end(url)
+                seen.add(target)
+                url = target
+        return url
+
+    def remember(self, url: str, target: str):
+        with self._lock:
+            self._targets[url] = target
+            self._targets.move_to_end(url)
+            while len(self._targets) > self.max_entries:
+                self._targets.popitem(last=False)
+
+    def forget(self, url: str):
+        """删除从 url 出发的整条缓存重定向链"""
+        with self._lock:
+            for _ in range(MAX_REDIRECTS):
+                url = self._targets.pop(url, None)
+                if url is None:
+                    break
+
+    def __len__(self):
+        return len(self._targets)
+
+redirect_cache = RedirectCache()
+
+def content_length(res: requests.Response) -> int:
+    """响应头中的 Content-Length，缺失或格式错误时返回 -1"""
+    try:
+        return int(res.headers.get('Content-Length') or -1)
+    except ValueError:
+        return -1
+
+def release_response(res: requests.Response, stats: TransferStats) -> int:
+    """不再需要响应体时释放响应：小响应体读完以便连接放回连接池，否则直接关闭
+
+    返回跳过下载的字节数（按 Content-Length 估算）。
+    """
+    length = content_length(res)
+    if 0 <= length <= PROBE_DRAIN_LIMIT:
+        stats.record(received=len(res.content))
+        return 0
+    res.close()
+    skipped = max(length, 0)
+    stats.record(skipped=skipped)
+    return skipped
+
+def _follow_redirects(session: requests.Session, method: str, url: str, stats: TransferStats, **kwargs):
+    visited = {url}
+    for _ in range(MAX_REDIRECTS + 1):
+        stats.record(request=True)
+        res = http_request(session, method, url, allow_redirects=False, **kwargs)
+        location = res.headers.get('Location')
+        if res.status_code not in REDIRECT_STATUS_CODES or not location:
+            return url, res
+        release_response(res, stats)
+        target = urljoin(url, location)
+        if res.status_code in PERMANENT_REDIRECT_CODES:
+            redirect_cache.remember(url, target)
+        if target in visited:
+            raise requests.exceptions.TooManyRedirects(f"检测到重定向循环: {target}")
+        visited.add(target)
+        url = target
+    raise requests.exceptions.TooManyRedirects(f"重定向超过 {MAX_REDIRECTS} 次")
+
+def request_following_redirects(session: requests.Session, method: str, url: str, stats: TransferStats, **kwargs):
+    """由客户端逐跳跟随重定向，返回 (最终链接, 响应)
+
+    支持 301/302/303/307/308，跳数受 MAX_REDIRECTS 限制并检测循环；中间响应不下载响应体。
+    已缓存的永久重定向直接跳到最终链接，若最终链接请求失败则清除缓存并从原链接重新解析。
+    """
+    start = redirect_cache.resolve(url)
+    if start == url:
+        return _follow_redirects(session, method, url, stats, **kwargs)
+    try:
+        final_url, res = _follow_redirects(session, method, start, stats, **kwargs)
+        if res.status_code < 400:
+            return final_url, res
+        res.close()
+    except requests.exceptions.RequestException:
+        pass
+    redirect_cache.forget(url)
+    return _follow_redirects(session, method, url, stats, **kwargs)
+
+def probe_subscription(url: str, headers: dict = None, session: requests.Session = None, stats: TransferStats = None):
+    """探测订阅链接并跟随跳转，返回 (最终链接, 响应)
+
+    响应头中已有 subscription-userinfo 或状态码不是 200 时不下载响应体；
+    否则响应体保持未读，由调用方通过 scan_body() 按需下载。
+    """
+    session = session or http_session
+    stats = stats or transfer_stats
+
+    if PROBE_HEAD:
+        try:
+            final_url, res = request_following_redirects(session, 'HEAD', url, stats, headers=headers)
+            if res.status_code == 200 and 'subscription-userinfo' in res.headers:
+                stats.record(header_only=True)
+                return final_url, res
+        except requests.exceptions.RequestException:
+            pass
+
+    final_url, res = request_following_redirects(session, 'GET', url, stats, headers=headers, stream=True)
+    if res.status_code != 200 or 'subscription-userinfo' in res.headers:
+        release_response(res, stats)
+        stats.record(header_only=res.status_code == 200)
+    return final_url, res
+
+NODE_INFO_KEYS = ('upload', 'download', 'total', 'expire')
+# 响应体中流量信息的各种写法：upload=1 / total: 2 / 总流量 3（在转为小写的内容上匹配）。
+# 数字后紧跟 - . / : 的（如日期 expire: 2025-01-01）不是字节数或时间戳，不匹配
+NODE_INFO_PATTERN = re.compile(
+    rb'(?:(upload|download|total|expire)[ \t]*[=:]|' + '总流量'.encode() + rb'[ \t]*(?:[=:]|' + '：'.encode() + rb')?)'
+    rb'[ \t]*(\d+)(?![\d.:/-])'
+)
+# 先用 bytes.find 定位关键字再在该处匹配，比直接用正则扫描整块内容快得多
+NODE_INFO_NEEDLES = ((b'upload', 'upload'), (b'download', 'download'), (b'total', 'total'),
+                     (b'expire', 'expire'), ('总流量'.encode(), 'total'))
+BASE64_HEAD_PATTERN = re.compile(rb'[A-Za-z0-9+/=_\-\s]+')
+BASE64_URLSAFE_TABLE = bytes.maketrans(b'-_', b'+/')
+NODE_SCAN_CHUNK = 16 * 1024  # 逐块读取响应体的块大小
+BASE64_HEAD_SIZE = 1024  # 根据响应体开头多少字节判断是否为 base64
+NODE_SCAN_LINE = 4096  # 块末尾未结束的行最多保留的长度，留到下一块一起匹配
+
+class NodeListScanner:
+    """逐块扫描订阅响应体（节点列表）中的流量信息
+
+    响应体开头只含 base64 字符、没有明文的流量字段且解码后是 UTF-8 文本时逐块解码
+    （兼容 URL 安全字符和缺失的填充），否则按明文扫描。
+    所有写法由 NODE_INFO_PATTERN 一次匹配，每个字段取第一次出现的值；
+    块末尾可能被截断的内容留到下一块一起匹配。四个字段都找到后 feed() 返回 True，无需继续读取。
+    """
+
+    def __init__(self):
+        self.info = {}
+        self.ss_link = None
+        self._base64 = None  # 读够 BASE64_HEAD_SIZE 字节或响应体结束后确定
+        self._head = b''  # 判断编码前累积的开头数据
+        self._carry = b''  # 不足 4 个字符、留到下一块解码的 base64 数据
+        self._tail = b''
+
+    @property
+    def done(self) -> bool:
+        return len(self.info) == len(NODE_INFO_KEYS)
+
+    def feed(self, chunk: bytes) -> bool:
+        if self._base64 is None:
+            # 凑够开头的数据再判断编码，结果不受分块大小影响
+            self._head += chunk
+            if len(self._head) < BASE64_HEAD_SIZE:
+                return False
+            chunk, self._head = self._head, b''
+            self._base64 = self._looks_like_base64(chunk[:BASE64_HEAD_SIZE])
+        if self._base64:
+            decoded = self._decode(self._carry + chunk.translate(BASE64_URLSAFE_TABLE, b' \t\r\n'), final=False)
+            if decoded is not None:
+                chunk = decoded
+        self._scan(chunk, final=False)
+        return self.done
+
+    def finish(self):
+        """响应体读完后调用，处理剩余的数据"""
+        chunk = b''
+        if self._base64 is None:
+            # 响应体不足 BASE64_HEAD_SIZE 字节
+            chunk, self._head = self._head, b''
+            self._base64 = self._looks_like_base64(chunk)
+            if self._base64:
+                self._carry, chunk = chunk.translate(BASE64_URLSAFE_TABLE, b' \t\r\n'), b''
+        if self._base64 and self._carry:
+            chunk = self._decode(self._carry + b'=' * (-len(self._carry) % 4), final=True) or b''
+        self._scan(chunk, final=True)
+
+    @staticmethod
+    def _looks_like_base64(head: bytes) -> bool:
+        # upload=1024 这样的明文也只含 base64 字符，需排除明文的流量字段和解码结果不是文本的情况
+        if BASE64_HEAD_PATTERN.fullmatch(head) is None or NODE_INFO_PATTERN.search(head.lower()):
+            return False
+        data = head.translate(BASE64_URLSAFE_TABLE, b' \t\r\n')
+        try:
+            text = base64.b64decode(data[:len(data) - len(data) % 4])
+            text.decode('utf-8')
+        except binascii.Error:
+            return False
+        except UnicodeDecodeError as e:
+            # 截断处可能切开多字节字符
+            return e.reason == 'unexpected end of data' and e.end == len(text)
+        return True
+
+    def _decode(self, data: bytes, final: bool):
+        """解码 base64 数据，无法解码时改为按明文扫描并返回 None，由调用方扫描原始内容"""
+        size = len(data) if final else len(data) - len(data) % 4
+        self._carry = data[size:]
+        try:
+            return base64.b64decode(data[:size])
+        except binascii.Error:
+            self._base64 = False
+            self._carry = b''
+            return None
+
+    def _scan(self, data: bytes, final: bool):
+        text = self._tail + data
+        if final:
+            text += b'\n'  # 让最后一行的 ss:// 链接也能匹配
+        end = len(text)
+        keep = max(text.rfind(b'\n', max(end - NODE_SCAN_LINE, 0)) + 1, end - NODE_SCAN_LINE, 0)
+        lowered = text.lower()
+        found = []
+        for needle, key in NODE_INFO_NEEDLES:
+            if key in self.info:
+                continue
+            pos = lowered.find(needle)
+            while pos >= 0:
+                match = NODE_INFO_PATTERN.match(lowered, pos)
+                if match:
+                    if match.end() == end and not final:
+                        # 数字可能在下一块中继续
+                        keep = min(keep, pos)
+                    else:
+                        found.append((pos, key, int(match.group(2))))
+                    break
+                pos = lowered.find(needle, pos + len(needle))
+        # total 有两种写法，取位置靠前的
+        for _, key, value in sorted(found):
+            self.info.setdefault(key, value)
+        if self.ss_link is None:
+            self._find_ss_link(text)
+        self._tail = b'' if final else text[keep:]
+
+    def _find_ss_link(self, text: bytes):
+        """记录第一个完整的 ss:// 行，内容中没有流量信息时用于回退查询"""
+        # 按行首查找，跳过 vmess:// 等链接中的 ss://
+        if text.startswith(b'ss://'):
+            pos = 0
+        else:
+            pos = text.find(b'\nss://')
+            if pos < 0:
+                return
+            pos += 1
+        line_end = text.find(b'\n', pos)
+        if line_end >= 0:  # 行未结束时留到下一块
+            self.ss_link = text[pos:line_end].rstrip(b'\r').decode('utf-8', errors='replace')
+
+def scan_body(res: requests.Response, scanner: NodeListScanner, stats: TransferStats = None):
+    """逐块下载 probe_subscription() 返回的响应体交给 scanner，找齐所有字段后关闭响应，不再下载"""
+    received = 0
+    skipped = 0
+    for chunk in res.iter_content(NODE_SCAN_CHUNK):
+        received += len(chunk)
+        if scanner.feed(chunk):
+            res.close()
+            skipped = max(content_length(res) - received, 0)
+            break
+    else:
+        scanner.finish()
+    (stats or transfer_stats).record(received=received, skipped=skipped)
+
+def query_node_server(url: str, ss_link: str) -> dict:
+    """尝试从 SS 节点所在服务器的常见 API 路径获取流量信息，都失败时从订阅链接参数中获取"""
+    info = {}
+    ss_parts = ss_link.split('@')
+    if len(ss_parts) != 2:
+        return info
+    # 获取服务器地址和端口
+    server = ss_parts[1].split('#')[0]
+    logging.debug(f"服务器信息: {server}")
+    api_paths = [
+        '/user/info',
+        '/api/user/info',
+        '/api/v1/user/info',
+        '/api/v1/user/traffic',
+        '/api/user/traffic'
+    ]
+    for path in api_paths:
+        try:
+            server_url = f"http://{server}{path}"
+            server_response = http_request(http_session, 'GET', server_url, retries=0)
+            if server_response.status_code == 200:
+                server_info = server_response.json()
+                if isinstance(server_info, dict):
+                    # 尝试不同的字段名
+                    info["upload"] = server_info.get('u', server_info.get('upload', 0))
+                    info["download"] = server_info.get('d', server_info.get('download', 0))
+                    info["total"] = server_info.get('transfer_enable', server_info.get('total', 0))
+                    info["expire"] = server_info.get('expire', 0)
+                    logging.debug(f"从服务器获取到信息: {server_info}")
+                    return info
+        except Exception as e:
+            logging.debug(f"尝试 {server_url} 失败: {str(e)}")
+
+    # 如果所有 API 都失败，尝试从 URL 参数获取
+    try:
+        params = parse_qs(urlparse(url).query)
+        for key in NODE_INFO_KEYS:
+            if key in params:
+                info[key] = int(params[key][0])
+    except Exception as e:
+        logging.debug(f"解析 URL 参数失败: {str(e)}")
+    return info
+
+def traffic_from_body(url: str, res: requests.Response, stats: TransferStats = None):
+    """响应头中没有 subscription-userinfo 时，从响应体（节点列表）中解析流量信息，找不到时返回 None"""
+    scanner = NodeListScanner()
+    scan_body(res, scanner, stats)
+    info = scanner.info
+    if 'total' not in info and scanner.ss_link:
+        # 内容中没有流量信息时，尝试从 SS 节点所在服务器获取，内容中已有的字段优先
+        info = {**query_node_server(url, scanner.ss_link), **info}
+    if 'total' not in info:
+        return None
+    return TrafficInfo(info.get('upload', 0), info.get('download', 0), info['total'], info.get('expire'))
+
+class UserinfoCache:
+    """按最终链接缓存解析后的订阅流量信息
+
+    条目在 CACHE_TTL 内直接命中；过期后保留 ETag/Last-Modified 用于条件请求，
+    超过 CACHE_MAX_ENTRIES 时淘汰最久未使用的条目。请求链接通过别名表映射到最终链接。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._aliases = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def _lookup(self, url: str):
+        final_url = self._aliases.get(url, url)
+        entry = self._entries.get(final_url)
+        if entry is not None:
+            self._entries.move_to_end(final_url)
+            if url in self._aliases:
+                self._aliases.move_to_end(url)
+        return entry
+
+    def get(self, url: str):
+        """返回未过期的缓存条目，并计入命中/未命中"""
+        with self._lock:
+            entry = self._lookup(url)
+            if entry is not None and entry['expires_at'] > time.time():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def get_stale(self, url: str):
+        """返回可用于条件请求的已过期条目"""
+        with self._lock:
+            entry = self._lookup(url)
+            if entry is not None and (entry['etag'] or entry['last_modified']):
+                return entry
+            return None
+
+    def put(self, url: str, entry: dict, revalidated: bool = False):
+        entry['expires_at'] = time.time() + CACHE_TTL
+        with self._lock:
+            self.revalidated += int(revalidated)
+            self._entries[entry['url']] = entry
+            self._entries.move_to_end(entry['url'])
+            if url != entry['url']:
+                self._aliases[url] = entry['url']
+                self._aliases.move_to_end(url)
+            while len(self._entries) > CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+            while len(self._aliases) > CACHE_MAX_ENTRIES:
+                self._aliases.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated
+            }
+
+userinfo_cache = UserinfoCache()
+
+def fetch_userinfo(url: str, headers: dict = None, force: bool = False, stats: TransferStats = None) -> dict:
+    """获取订阅的流量信息，优先使用缓存
+
+    返回 {'url': 最终链接, 'status_code': 状态码, 'traffic': 解析后的 TrafficInfo 或 None}。
+    响应头中没有 subscription-userinfo 时从响应体（节点列表）中解析。
+    force 为 True 时跳过缓存直接请求；只有解析出流量信息的 200 响应会被缓存。
+    """
+    if not force:
+        entry = userinfo_cache.get(url)
+        if entry is not None:
+            return entry
+
+    stale = None if force else userinfo_cache.get_stale(url)
+    request_headers = dict(headers or {})
+    if stale is not None:
+        if stale['etag']:
+            request_headers['If-None-Match'] = stale['etag']
+        if stale['last_modified']:
+            request_headers['If-Modified-Since'] = stale['last_modified']
+
+    final_url, res = probe_subscription(stale['url'] if stale else url, request_headers, stats=stats)
+    revalidated = res.status_code == 304 and stale is not None
+    if revalidated:
+        entry = dict(stale)
+    else:
+        userinfo = res.headers.get('subscription-userinfo')
+        if res.status_code == 200 and not userinfo:
+            # 响应头中没有流量信息，逐块读取 probe_subscription() 留下的响应体查找
+            traffic = traffic_from_body(url, res, stats)
+        else:
+            try:
+                traffic = TrafficInfo.from_header(userinfo) if userinfo else None
+            except ValueError:
+                traffic = None
+        entry = {
+            'url': final_url,
+            'status_code': res.status_code,
+            'traffic': traffic,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified')
+        }
+    if entry['status_code'] == 200 and entry['traffic'] is not None:
+        userinfo_cache.put(url, entry, revalidated)
+    return entry
+
+class SingleFlight:
+    """合并相同键的并发请求：同一时刻只发出一个上游请求，其余调用方共享结果"""
+
+    def __init__(self):
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        """执行 func() 返回的协程；已有相同键的请求在进行时直接等待其结果"""
+        task = self._flights.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(func())
+            self._flights[key] = task
+
+            def done(finished):
+                if self._flights.get(key) is finished:
+                    del self._flights[key]
+                if not finished.cancelled():
+                    finished.exception()  # 所有调用方都已取消时避免 "exception was never retrieved"
+
+            task.add_done_callback(done)
+        else:
+            self.coalesced += 1
+        # shield：单个调用方超时取消时不影响其他共享该请求的调用方
+        return await asyncio.shield(task)
+
+userinfo_flights = SingleFlight()
+
+def normalize_url(url: str) -> str:
+    """规范化链接用作请求合并的键：协议和主机名转小写、去掉默认端口和片段"""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return parsed._replace(scheme=scheme, netloc=netloc, fragment='').geturl()
+
+async def fetch_userinfo_shared(url: str, headers: dict = None, force: bool = False, stats: TransferStats = None) -> dict:
+    """在 io_executor 中执行 fetch_userinfo()，同一链接的并发调用共享一次请求和解析结果"""
+    return await userinfo_flights.do(
+        (normalize_url(url), force),
+        lambda: io_executor.run(fetch_userinfo, url, headers, force, stats)
+    )
+
+async def gather_in_order(func, items: list, on_result=None) -> list:
+    """并发等待 func(item) 返回的协程，按原顺序返回结果
+
+    并发数受 FETCH_CONCURRENCY 限制，整体耗时受 CHECK_DEADLINE 限制；
+    出错的项返回对应的异常对象，超时未完成的项返回 asyncio.TimeoutError。
+    每完成一项即以 on_result(下标, 结果) 回调，回调顺序即完成顺序。
+    """
+    if not items:
+        return []
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def run(index, item):
+        async with semaphore:
+            try:
+                result = await func(item)
+            except Exception as e:
+                result = e
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    tasks = [asyncio.ensure_future(run(index, item)) for index, item in enumerate(items)]
+    _, pending = await asyncio.wait(tasks, timeout=CHECK_DEADLINE)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for task in tasks:
+        if task in pending:
+            results.append(asyncio.TimeoutError("检查超时"))
+        else:
+            results.append(task.result())
+    return results
+
+# ------------------ 订阅存储 ------------------
+class SubscriptionStore:
+    """基于 SQLite（WAL 模式）的订阅存储，每次修改都在单个事务中完成
+
+    name 列带唯一索引，按名称查找和改名冲突检查都走索引；id 自增，保持添加顺序。
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL UNIQUE,
+                    url TEXT NOT NULL,
+                    custom_message TEXT NOT NULL DEFAULT ''
+                )
+            """)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def attach(self, *schema: str):
+        """其他功能模块的表也放在订阅数据库中：在一个事务中建表，返回共用的 (连接, 锁)"""
+        with self.lock, self.conn:
+            for statement in schema:
+                self.conn.execute(statement)
+        return self.conn, self.lock
+
+    def get_meta(self, key: str):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def load_all(self) -> list:
+        with self.lock:
+            rows = self.conn.execute("SELECT id, name, url, custom_message FROM subscriptions ORDER BY id").fetchall()
+        return [Subscription(*row) for row in rows]
+
+    def get(self, name: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, name, url, custom_message FROM subscriptions WHERE name = ?", (name,)
+            ).fetchone()
+        return Subscription(*row) if row else None
+
+    def insert(self, name: str, url: str, custom_message: str = ""):
+        """添加订阅并返回其 id，名称已存在时返回 None"""
+        try:
+            with self.lock, self.conn:
+                cursor = self.conn.execute(
+                    "INSERT INTO subscriptions (name, url, custom_message) VALUES (?, ?, ?)",
+                    (name, url, custom_message)
+                )
+            return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    def insert_many(self, subscriptions: list) -> list:
+        """在一个事务中批量添加订阅，已存在的名称被跳过，返回实际添加的订阅（带 id）"""
+        added = []
+        with self.lock, self.conn:
+            for sub in subscriptions:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO subscriptions (name, url, custom_message) VALUES (?, ?, ?)",
+                    (sub.name, sub.url, sub.custom_message)
+                )
+                if cursor.rowcount:
+                    added.append(Subscription(cursor.lastrowid, sub.name, sub.url, sub.custom_message))
+        return added
+
+    def update(self, name: str, new_name: str = None, new_url: str = None, new_message: str = None) -> bool:
+        """修改订阅，名称不存在或新名称已被占用时返回 False"""
+        try:
+            with self.lock, self.conn:
+                cursor = self.conn.execute(
+                    "UPDATE subscriptions SET name = COALESCE(?, name), url = COALESCE(?, url), "
+                    "custom_message = COALESCE(?, custom_message) WHERE name = ?",
+                    (new_name, new_url, new_message, name)
+                )
+            return cursor.rowcount > 0
+        except sqlite3.IntegrityError:
+            return False
+
+    def delete(self, name: str) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute("DELETE FROM subscriptions WHERE name = ?", (name,))
+        return cursor.rowcount > 0
+
+    def migrate_json(self, path: str):
+        """首次启动时导入旧版 subscriptions.json，之后不再读取该文件"""
+        if self.get_meta('json_migrated') or not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            subscriptions = [Subscription(None, sub['name'], sub['url'], sub.get('custom_message', ''))
+                             for sub in json.load(f)]
+        imported = len(self.insert_many(subscriptions))
+        self.set_meta('json_migrated', datetime.now(TIMEZONE).isoformat())
+        logging.info(f"已从 {path} 导入 {imported} 个订阅到 {SUBSCRIPTIONS_DB}，该文件不再使用")
 
 # ------------------ 订阅管理类 ------------------
 class SubscriptionManager:
+    """订阅管理：内存中按名称和添加顺序维护索引，修改同步写入 SubscriptionStore
+
+    _by_name 用于按名称查找，_by_id 以数据库 id 为键保持添加顺序；
+    两者都是字典，查找、改名和删除均为 O(1)。
+    """
+
     def __init__(self):
-        self.session = requests.Session()
+        self.store = SubscriptionStore(SUBSCRIPTIONS_DB)
         self.load_subscriptions()
 
     def load_subscriptions(self):
-        if os.path.exists(SUBSCRIPTIONS_FILE):
-            with open(SUBSCRIPTIONS_FILE, 'r', encoding='utf-8') as f:
-                self.subscriptions = json.load(f)
-        else:
-            self.subscriptions = []
-            self.save_subscriptions()
+        self.store.migrate_json(SUBSCRIPTIONS_FILE)
+        self._by_id = {}
+        self._by_name = {}
+        for sub in self.store.load_all():
+            self._index(sub)
+
+    def _index(self, sub: Subscription):
+        self._by_id[sub.id] = sub
+        self._by_name[sub.name] = sub
+
+    @property
+    def subscriptions(self) -> list:
+        """按添加顺序返回所有订阅的快照"""
+        return list(self._by_id.values())
 
-    def save_subscriptions(self):
-        with open(SUBSCRIPTIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.subscriptions, f, ensure_ascii=False, indent=2)
+    def __len__(self):
+        return len(self._by_id)
+
+    def get_subscription(self, name: str):
+        return self._by_name.get(name)
 
     def add_subscription(self, name: str, url: str, custom_message: str = "") -> bool:
-        if any(sub['name'] == name for sub in self.subscriptions):
+        if name in self._by_name:
+            return False
+        sub_id = self.store.insert(name, url, custom_message)
+        if sub_id is None:
             return False
-        self.subscriptions.append({
-            'name': name,
-            'url': url,
-            'custom_message': custom_message
-        })
-        self.save_subscriptions()
+        self._index(Subscription(sub_id, name, url, custom_message))
         return True
 
     def edit_subscription(self, old_name: str, new_name: str = None, new_url: str = None, new_message: str = None) -> bool:
         """修改订阅信息"""
-        for sub in self.subscriptions:
-            if sub['name'] == old_name:
-                if new_name is not None:
-                    # 检查新名称是否与其他订阅重复
-                    if new_name != old_name and any(s['name'] == new_name for s in self.subscriptions):
-                        return False
-                    sub['name'] = new_name
-                if new_url is not None:
-                    sub['url'] = new_url
-                if new_message is not None:
-                    sub['custom_message'] = new_message
-                self.save_subscriptions()
-                return True
-        return False
+        sub = self._by_name.get(old_name)
+        if sub is None:
+            return False
+        # 检查新名称是否与其他订阅重复
+        if new_name is not None and new_name != old_name and new_name in self._by_name:
+            return False
+        if not self.store.update(old_name, new_name, new_url, new_message):
+            return False
+        if new_name is not None:
+            del self._by_name[old_name]
+            sub.name = new_name
+            self._by_name[new_name] = sub
+        if new_url is not None:
+            sub.url = new_url
+        if new_message is not None:
+            sub.custom_message = new_message
+        return True
 
     def remove_subscription(self, name: str) -> bool:
-        initial_length = len(self.subscriptions)
-        self.subscriptions = [sub for sub in self.subscriptions if sub['name'] != name]
-        if len(self.subscriptions) < initial_length:
-            self.save_subscriptions()
-            return True
-        return False
+        sub = self._by_name.get(name)
+        if sub is None or not self.store.delete(name):
+            return False
+        del self._by_name[name]
+        del self._by_id[sub.id]
+        return True
 
     def update_custom_message(self, name: str, custom_message: str) -> bool:
-        for sub in self.subscriptions:
-            if sub['name'] == name:
-                sub['custom_message'] = custom_message
-                self.save_subscriptions()
-                return True
-        return False
-
-    def format_size(self, bytes_size: int) -> str:
-        gb = bytes_size / (1024 ** 3)
-        return f"{gb:.2f} GB"
-
-    def parse_userinfo(self, userinfo: str) -> dict:
-        result = {}
-        for item in userinfo.split(';'):
-            if '=' in item:
-                key, value = item.split('=')
-                result[key.strip()] = int(value.strip())
-        return result
+        return self.edit_subscription(name, new_message=custom_message)
+
+    def add_subscriptions(self, entries: list):
+        """批量添加订阅：一次遍历完成去重，并在一个事务中写入
+
+        entries 为 (名称, 链接, 备注) 列表，名称为 None 时按链接的主机名生成。
+        名称或链接已存在（包括与同批次重复）的条目被跳过。
+        返回 (新增的订阅列表, 跳过的数量)。
+        """
+        taken_names = set(self._by_name)
+        taken_urls = {sub.url for sub in self._by_id.values()}
+        pending = []
+        skipped = 0
+        for name, url, custom_message in entries:
+            if url in taken_urls or (name is not None and name in taken_names):
+                skipped += 1
+                continue
+            if name is None:
+                base = urlparse(url).hostname or "订阅"
+                name, suffix = base, 2
+                while name in taken_names:
+                    name, suffix = f"{base}-{suffix}", suffix + 1
+            taken_names.add(name)
+            taken_urls.add(url)
+            pending.append(Subscription(None, name, url, custom_message))
+
+        added = self.store.insert_many(pending)
+        for sub in added:
+            self._index(sub)
+        return added, skipped + len(pending) - len(added)
 
-    
-    def check_subscription(self, name: str, url: str) -> dict:
-        try:
-            # 首先尝试使用parse_subscription_info方法
-            result = self.parse_subscription_info(url)
-            if 'error' not in result:
-                result['name'] = name
-                return result
-
-            # 如果parse_subscription_info失败，尝试从响应头获取信息
-            response = self.session.get(url)
-            response.raise_for_status()
-            userinfo = response.headers.get('subscription-userinfo')
-            if not userinfo:
-                return {'name': name, 'error': "无法获取订阅信息"}
-            
-            info = self.parse_userinfo(userinfo)
-            upload = info.get('upload', 0)
-            download = info.get('download', 0)
-            total = info.get('total', 0)
-            expire = info.get('expire', 0)
-            remaining = total - (upload + download)
-            used = upload + download
-            expire_date = datetime.fromtimestamp(expire).strftime('%Y-%m-%d')
-            return {
-                'name': name,
-                'remaining': self.format_size(remaining),
-                'used': self.format_size(used),
-                'expire_date': expire_date
-            }
-        except Exception as e:
-            return {'name': name, 'error': f"检查失败: {str(e)}"}
-
-    def format_status_message(self, results: list) -> str:
-        if not results:
-            return "❌ 没有订阅需要检查"
-        message = "📊 订阅状态报告\n\n"
-        for result in results:
-            if 'error' in result:
-                message += f"❌ {result['name']}: {result['error']}\n"
+# ------------------ 订阅实例 ------------------
+subscription_manager = None  # 由 init_services() 创建
+
+# ------------------ 流量历史 ------------------
+class TrafficHistory:
+    """订阅流量历史，与订阅存储共用同一个 SQLite 连接
+
+    每次检查的结果写入 traffic_hourly（每小时只保留最后一次，保存 history_raw_days 天），
+    同时降采样到 traffic_daily（每天只保留最后一次，保存 history_days 天）。
+    两张表都是以 (sub_id, 时间) 为主键的 WITHOUT ROWID 表，查询单个订阅一段时间的历史
+    只是一次主键范围扫描，与历史总量无关。
+    """
+
+    PURGE_INTERVAL = 86400
+
+    def __init__(self, store: SubscriptionStore):
+        self._last_purge = 0
+        self.conn, self._lock = store.attach(*(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                sub_id INTEGER NOT NULL,
+                {key} INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                upload INTEGER NOT NULL,
+                download INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                expire INTEGER,
+                PRIMARY KEY (sub_id, {key})
+            ) WITHOUT ROWID
+        """ for table, key in (('traffic_hourly', 'hour'), ('traffic_daily', 'day'))))
+
+    @staticmethod
+    def day_of(ts: int) -> int:
+        """时间戳所在的本地日期（按 TIMEZONE），以公历序数表示"""
+        return datetime.fromtimestamp(ts, TIMEZONE).toordinal()
+
+    def record_many(self, samples: list, now: float = None):
+        """在一个事务中写入一批 (sub_id, TrafficInfo) 样本"""
+        ts = int(now if now is not None else time.time())
+        hour = ts - ts % 3600
+        day = self.day_of(ts)
+        rows = [(sub_id, ts, traffic.upload, traffic.download, traffic.total, traffic.expire)
+                for sub_id, traffic in samples]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO traffic_hourly (sub_id, hour, ts, upload, download, total, expire) "
+                f"VALUES (?, {hour}, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO traffic_daily (sub_id, day, ts, upload, download, total, expire) "
+                f"VALUES (?, {day}, ?, ?, ?, ?, ?)", rows
+            )
+            if ts - self._last_purge >= self.PURGE_INTERVAL:
+                self._last_purge = ts
+                self.conn.execute("DELETE FROM traffic_hourly WHERE hour < ?", (ts - HISTORY_RAW_DAYS * 86400,))
+                self.conn.execute("DELETE FROM traffic_daily WHERE day < ?", (day - HISTORY_DAYS,))
+
+    def hourly(self, sub_id: int, since: int) -> list:
+        """返回 since 之后的小时样本 [(ts, upload, download, total, expire)]，按时间排序"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT ts, upload, download, total, expire FROM traffic_hourly "
+                "WHERE sub_id = ? AND hour >= ? ORDER BY hour", (sub_id, since - since % 3600)
+            ).fetchall()
+
+    def daily(self, sub_id: int, days: int, now: float = None) -> list:
+        """返回最近 days 天的每日样本 [(day, ts, upload, download, total, expire)]，按日期排序"""
+        today = self.day_of(int(now if now is not None else time.time()))
+        with self._lock:
+            return self.conn.execute(
+                "SELECT day, ts, upload, download, total, expire FROM traffic_daily "
+                "WHERE sub_id = ? AND day > ? ORDER BY day", (sub_id, today - days)
+            ).fetchall()
+
+    def forget(self, sub_id: int):
+        """删除订阅的全部历史"""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM traffic_hourly WHERE sub_id = ?", (sub_id,))
+            self.conn.execute("DELETE FROM traffic_daily WHERE sub_id = ?", (sub_id,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            hourly = self.conn.execute("SELECT COUNT(*) FROM traffic_hourly").fetchone()[0]
+            daily = self.conn.execute("SELECT COUNT(*) FROM traffic_daily").fetchone()[0]
+        return {'hourly': hourly, 'daily': daily}
+
+def usage_increments(samples: list) -> list:
+    """由 [(ts, 已用流量)] 计算相邻样本之间的用量；已用流量变小视为流量重置，重置后的已用量计为用量"""
+    increments = []
+    for (_, previous), (ts, used) in zip(samples, samples[1:]):
+        increments.append((ts, used - previous if used >= previous else used))
+    return increments
+
+def burn_rate(samples: list):
+    """由 [(ts, 已用流量)] 计算日均消耗（字节/天），样本跨度不足一小时返回 None"""
+    if len(samples) < 2:
+        return None
+    elapsed = samples[-1][0] - samples[0][0]
+    if elapsed < 3600:
+        return None
+    return sum(delta for _, delta in usage_increments(samples)) * 86400 / elapsed
+
+def project_exhaustion(traffic: TrafficInfo, rate, now: float = None):
+    """按日均消耗估算流量用完的时间戳，不会用完（无消耗）时返回 None"""
+    if not rate or rate <= 0:
+        return None
+    now = now if now is not None else time.time()
+    return now + max(traffic.remaining, 0) / rate * 86400
+
+traffic_history = None  # 由 init_services() 创建
+
+# ------------------ 流量告警 ------------------
+class AlertEngine:
+    """根据每次检查结果判断剩余流量和到期时间是否低于阈值
+
+    阈值分为全局阈值和单个订阅的阈值（覆盖全局，0 表示关闭）。告警在条件首次满足时触发，
+    条件持续期间每隔 alert_cooldown_hours 才重复提醒一次，条件解除后状态清除，
+    下次再满足时立即提醒。规则和状态都常驻内存，每个样本的判断只是几次字典查找，
+    只有状态变化时才写入数据库，重启后冷却状态不会丢失。
+    evaluate() 返回的告警在 settle() 确认送达后才开始冷却，发送失败的告警下次检查时重新提醒。
+    """
+
+    KINDS = ('traffic', 'expire')
+
+    def __init__(self, store: SubscriptionStore):
+        self.remaining_gb = ALERT_REMAINING_GB
+        self.expire_days = ALERT_EXPIRE_DAYS
+        self.cooldown = ALERT_COOLDOWN_HOURS * 3600
+        self.fired = 0
+        self._pending = set()  # 已返回但尚未确认送达的告警，避免并发检查重复提醒
+        self.conn, self._lock = store.attach("""
+            CREATE TABLE IF NOT EXISTS alert_rules (
+                sub_id INTEGER PRIMARY KEY,
+                remaining_gb REAL,
+                expire_days REAL
+            )
+        """, """
+            CREATE TABLE IF NOT EXISTS alert_state (
+                sub_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                fired_at INTEGER NOT NULL,
+                PRIMARY KEY (sub_id, kind)
+            ) WITHOUT ROWID
+        """)
+        # sub_id -> (剩余流量阈值 GB, 到期天数阈值)，None 表示沿用全局阈值
+        self._rules = {row[0]: (row[1], row[2]) for row in
+                       self.conn.execute("SELECT sub_id, remaining_gb, expire_days FROM alert_rules")}
+        # (sub_id, kind) -> 上次提醒时间
+        self._state = {(row[0], row[1]): row[2] for row in
+                       self.conn.execute("SELECT sub_id, kind, fired_at FROM alert_state")}
+
+    def thresholds(self, sub_id: int):
+        """返回订阅生效的 (剩余流量阈值 GB, 到期天数阈值)"""
+        remaining_gb, expire_days = self._rules.get(sub_id, (None, None))
+        return (self.remaining_gb if remaining_gb is None else remaining_gb,
+                self.expire_days if expire_days is None else expire_days)
+
+    def set_rule(self, sub_id: int, remaining_gb=None, expire_days=None):
+        """设置订阅的阈值，两项都为 None 时恢复使用全局阈值"""
+        with self._lock, self.conn:
+            if remaining_gb is None and expire_days is None:
+                self._rules.pop(sub_id, None)
+                self.conn.execute("DELETE FROM alert_rules WHERE sub_id = ?", (sub_id,))
             else:
-                message += f"🔹 {result['name']}\n"
-                message += f"📥 剩余流量: {result['remaining']}\n"
-                message += f"📤 已用流量: {result['used']}\n"
-                message += f"📅 到期时间: {result['expire_date']}\n"
-                if 'custom_message' in result and result['custom_message']:
-                    message += f"💬 备注: {result['custom_message']}\n"
-            message += "➖➖➖➖➖➖➖➖➖➖\n"
-        return message
-
-    def parse_subscription_info(self, url: str) -> dict:
-        try:
-            response = self.session.get(url)
-            response.raise_for_status()
-            
-            # 首先尝试从响应头获取信息
-            userinfo = response.headers.get('subscription-userinfo')
-            if userinfo:
-                print(f"找到 subscription-userinfo: {userinfo}")
-                info = self.parse_userinfo(userinfo)
-                upload = info.get('upload', 0)
-                download = info.get('download', 0)
-                total = info.get('total', 0)
-                expire = info.get('expire', 0)
-                remaining = total - (upload + download)
-                used = upload + download
-                expire_date = datetime.fromtimestamp(expire).strftime('%Y-%m-%d')
-                return {
-                    'name': "temp",
-                    'remaining': self.format_size(remaining),
-                    'used': self.format_size(used),
-                    'expire_date': expire_date
-                }
-            
-            # 如果没有 subscription-userinfo 头，尝试从响应内容解析
-            content = response.text
-            print(f"原始内容: {content[:200]}")  # 打印前200个字符
-            
-            try:
-                # 尝试 base64 解码
-                content = base64.b64decode(content).decode('utf-8')
-                print(f"Base64解码后: {content[:200]}")  # 打印前200个字符
-            except Exception as e:
-                print(f"Base64解码失败: {str(e)}")
-
-            # 解析流量信息
-            info = {
-                "upload": 0,
-                "download": 0,
-                "total": 0,
-                "expire": 0
-            }
+                self._rules[sub_id] = (remaining_gb, expire_days)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO alert_rules (sub_id, remaining_gb, expire_days) VALUES (?, ?, ?)",
+                    (sub_id, remaining_gb, expire_days)
+                )
 
-            # 从内容中提取信息
-            lines = content.split('\n')
-            print(f"总行数: {len(lines)}")
-            
-            # 检查是否是 SS 链接
-            if any(line.startswith('ss://') for line in lines):
-                print("检测到 SS 链接")
-                # 获取第一个有效的 SS 链接
-                ss_link = next((line for line in lines if line.startswith('ss://')), None)
-                if ss_link:
-                    try:
-                        # 解析 SS 链接
-                        ss_parts = ss_link.split('@')
-                        if len(ss_parts) == 2:
-                            # 获取服务器地址和端口
-                            server = ss_parts[1].split('#')[0]
-                            print(f"服务器信息: {server}")
-                            
-                            # 尝试从服务器获取流量信息
-                            try:
-                                # 尝试不同的 API 路径
-                                api_paths = [
-                                    '/user/info',
-                                    '/api/user/info',
-                                    '/api/v1/user/info',
-                                    '/api/v1/user/traffic',
-                                    '/api/user/traffic'
-                                ]
-                                
-                                for path in api_paths:
-                                    try:
-                                        server_url = f"http://{server}{path}"
-                                        print(f"尝试获取服务器信息: {server_url}")
-                                        server_response = self.session.get(server_url, timeout=5)
-                                        if server_response.status_code == 200:
-                                            server_info = server_response.json()
-                                            if isinstance(server_info, dict):
-                                                # 尝试不同的字段名
-                                                info["upload"] = server_info.get('u', server_info.get('upload', 0))
-                                                info["download"] = server_info.get('d', server_info.get('download', 0))
-                                                info["total"] = server_info.get('transfer_enable', server_info.get('total', 0))
-                                                info["expire"] = server_info.get('expire', 0)
-                                                print(f"从服务器获取到信息: {server_info}")
-                                                break
-                                    except Exception as e:
-                                        print(f"尝试 {path} 失败: {str(e)}")
-                                        continue
-                                
-                                # 如果所有 API 都失败，尝试从 URL 参数获取
-                                if all(v == 0 for v in info.values()):
-                                    try:
-                                        from urllib.parse import urlparse, parse_qs
-                                        parsed_url = urlparse(url)
-                                        params = parse_qs(parsed_url.query)
-                                        print(f"URL参数: {params}")
-                                        
-                                        if "upload" in params:
-                                            info["upload"] = int(params["upload"][0])
-                                        if "download" in params:
-                                            info["download"] = int(params["download"][0])
-                                        if "total" in params:
-                                            info["total"] = int(params["total"][0])
-                                        if "expire" in params:
-                                            info["expire"] = int(params["expire"][0])
-                                    except Exception as e:
-                                        print(f"解析 URL 参数失败: {str(e)}")
-                            except Exception as e:
-                                print(f"获取服务器信息失败: {str(e)}")
-                    except Exception as e:
-                        print(f"解析 SS 链接失败: {str(e)}")
-
-            # 从内容中提取信息
-            for line in lines:
-                line = line.lower()
-                print(f"处理行: {line[:100]}")  # 打印前100个字符
-                
-                if "upload=" in line:
-                    info["upload"] = int(line.split("=")[1].strip())
-                    print(f"找到上传: {info['upload']}")
-                elif "download=" in line:
-                    info["download"] = int(line.split("=")[1].strip())
-                    print(f"找到下载: {info['download']}")
-                elif "total=" in line:
-                    info["total"] = int(line.split("=")[1].strip())
-                    print(f"找到总量: {info['total']}")
-                elif "expire=" in line:
-                    info["expire"] = int(line.split("=")[1].strip())
-                    print(f"找到到期: {info['expire']}")
-                # 处理其他常见格式
-                elif "upload:" in line:
-                    info["upload"] = int(line.split(":")[1].strip())
-                    print(f"找到上传: {info['upload']}")
-                elif "download:" in line:
-                    info["download"] = int(line.split(":")[1].strip())
-                    print(f"找到下载: {info['download']}")
-                elif "total:" in line:
-                    info["total"] = int(line.split(":")[1].strip())
-                    print(f"找到总量: {info['total']}")
-                elif "expire:" in line:
-                    info["expire"] = int(line.split(":")[1].strip())
-                    print(f"找到到期: {info['expire']}")
-                # 处理特殊格式
-                elif "剩余流量" in line:
-                    remaining = line.split("剩余流量")[1].strip()
-                    print(f"找到剩余: {remaining}")
-                elif "总流量" in line:
-                    info["total"] = int(line.split("总流量")[1].strip())
-                    print(f"找到总量: {info['total']}")
-                elif "已用流量" in line:
-                    used = line.split("已用流量")[1].strip()
-                    print(f"找到已用: {used}")
-
-            # 计算流量
-            used = info["upload"] + info["download"]
-            remaining = info["total"] - used
-            expire_date = datetime.fromtimestamp(info["expire"]).strftime('%Y-%m-%d') if info["expire"] > 0 else "未知"
-            
-            print(f"计算结果: 上传={info['upload']}, 下载={info['download']}, 总量={info['total']}, 剩余={remaining}, 到期={expire_date}")
+    def has_rule(self, sub_id: int) -> bool:
+        return sub_id in self._rules
+
+    def forget(self, sub_id: int):
+        """删除订阅的阈值和告警状态"""
+        with self._lock, self.conn:
+            self._rules.pop(sub_id, None)
+            for kind in self.KINDS:
+                self._state.pop((sub_id, kind), None)
+            self.conn.execute("DELETE FROM alert_rules WHERE sub_id = ?", (sub_id,))
+            self.conn.execute("DELETE FROM alert_state WHERE sub_id = ?", (sub_id,))
+
+    def evaluate(self, sub: Subscription, traffic: TrafficInfo, now: float = None) -> list:
+        """判断一个检查结果，返回需要发送的告警 [((sub_id, kind), 告警文本 HTML)]
+
+        返回的告警发送后须调用 settle()，确认送达后才记录提醒时间。
+        """
+        now = int(now if now is not None else time.time())
+        remaining_gb, expire_days = self.thresholds(sub.id)
+        name = escape_html(sub.name)
+        conditions = {}
+        if remaining_gb and traffic.remaining < remaining_gb * 1024 ** 3:
+            conditions['traffic'] = (f"订阅 {name} 剩余流量 {StrOfSize(traffic.remaining)}，"
+                                     f"低于 {remaining_gb:g} GB")
+        if expire_days and traffic.expire is not None and traffic.expire - now < expire_days * 86400:
+            if traffic.expire > now:
+                conditions['expire'] = (f"订阅 {name} 将于 {traffic.expire_date()} 到期，"
+                                        f"剩余 {sec_to_data(traffic.expire - now)}")
+            else:
+                conditions['expire'] = f"订阅 {name} 已于 {traffic.expire_date()} 过期！"
+
+        alerts = []
+        cleared = []
+        for kind in self.KINDS:
+            key = (sub.id, kind)
+            fired_at = self._state.get(key)
+            if kind in conditions:
+                if (fired_at is None or now - fired_at >= self.cooldown) and key not in self._pending:
+                    self._pending.add(key)
+                    alerts.append((key, conditions[kind]))
+            elif fired_at is not None:
+                # 条件解除，下次满足时重新提醒
+                del self._state[key]
+                cleared.append(key)
+        if cleared:
+            with self._lock, self.conn:
+                self.conn.executemany("DELETE FROM alert_state WHERE sub_id = ? AND kind = ?", cleared)
+        return alerts
+
+    def settle(self, alerts: list, delivered: bool, now: float = None):
+        """告警发送结束后调用：送达的告警开始冷却，未送达的在下次检查时重新提醒"""
+        keys = [key for key, _ in alerts]
+        self._pending.difference_update(keys)
+        if not delivered or not keys:
+            return
+        now = int(now if now is not None else time.time())
+        for key in keys:
+            self._state[key] = now
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO alert_state (sub_id, kind, fired_at) VALUES (?, ?, ?)",
+                [(sub_id, kind, now) for sub_id, kind in keys]
+            )
+        self.fired += len(keys)
+
+    def active(self) -> int:
+        """当前处于告警状态的条目数"""
+        return len(self._state)
+
+alert_engine = None  # 由 init_services() 创建
+
+# ------------------ 自适应检查调度 ------------------
+class CheckScheduler:
+    """为每个订阅单独安排后台检查时间，并根据检查结果调整间隔
+
+    - 剩余流量或到期时间接近告警阈值（两倍以内）时使用最短间隔；
+    - 链接失效时按连续失败次数指数退避；状态良好（剩余过半且一个月内不到期）时逐次放宽间隔；
+    - 每个间隔都带随机抖动，新订阅和重启后已过期的任务在一个基准间隔内随机分散。
+    下次检查时间保存在数据库中，重启后按原计划继续。调度器每 SCHEDULE_TICK 秒与
+    订阅列表同步一次，因此增删改订阅和 /schedule 的设置无需重启即可生效。
+    """
+
+    def __init__(self, store: SubscriptionStore):
+        self._running = False
+        self.checked = 0
+        self.conn, self._lock = store.attach("""
+            CREATE TABLE IF NOT EXISTS check_schedule (
+                sub_id INTEGER PRIMARY KEY,
+                url TEXT NOT NULL,
+                next_due INTEGER NOT NULL,
+                interval INTEGER NOT NULL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                fixed_interval INTEGER
+            )
+        """)
+        # sub_id -> [url, 下次检查时间, 当前间隔, 连续失败次数, 固定间隔]
+        self._entries = {row[0]: list(row[1:]) for row in self.conn.execute(
+            "SELECT sub_id, url, next_due, interval, failures, fixed_interval FROM check_schedule")}
+
+    @staticmethod
+    def jitter(seconds: float) -> int:
+        return int(seconds * random.uniform(1 - SCHEDULE_JITTER, 1 + SCHEDULE_JITTER))
+
+    def _save(self, sub_ids):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO check_schedule (sub_id, url, next_due, interval, failures, fixed_interval) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(sub_id, *self._entries[sub_id]) for sub_id in sub_ids if sub_id in self._entries]
+            )
 
-            return {
-                'name': "temp",
-                'remaining': self.format_size(remaining),
-                'used': self.format_size(used),
-                'expire_date': expire_date
-            }
+    def sync(self, subscriptions: list, now: float = None):
+        """与订阅列表同步：新订阅和链接变化的订阅尽快检查，已删除的订阅不再调度"""
+        now = int(now if now is not None else time.time())
+        base = SCHEDULE_BASE_MINUTES * 60
+        current = {sub.id: sub for sub in subscriptions}
+        removed = [sub_id for sub_id in self._entries if sub_id not in current]
+        changed = []
+        for sub in subscriptions:
+            entry = self._entries.get(sub.id)
+            if entry is None:
+                # 新订阅在最初几个调度周期内分散检查
+                self._entries[sub.id] = [sub.url, now + random.randint(0, SCHEDULE_TICK * 4), base, 0, None]
+                changed.append(sub.id)
+            elif entry[0] != sub.url:
+                entry[0], entry[1], entry[3] = sub.url, now, 0
+                changed.append(sub.id)
+            elif entry[1] < now - base:
+                # 停机期间错过的检查在一个基准间隔内分散补上
+                entry[1] = now + random.randint(0, base)
+                changed.append(sub.id)
+        if removed:
+            for sub_id in removed:
+                del self._entries[sub_id]
+            with self._lock, self.conn:
+                self.conn.executemany("DELETE FROM check_schedule WHERE sub_id = ?", [(sub_id,) for sub_id in removed])
+        if changed:
+            self._save(changed)
+
+    def due(self, subscriptions: list, now: float = None) -> list:
+        """返回已到检查时间的订阅"""
+        now = now if now is not None else time.time()
+        return [sub for sub in subscriptions if sub.id in self._entries and self._entries[sub.id][1] <= now]
+
+    def next_interval(self, sub: Subscription, result, entry: list, now: float) -> int:
+        """根据检查结果计算下一次检查的间隔（秒）"""
+        base, low, high = SCHEDULE_BASE_MINUTES * 60, SCHEDULE_MIN_MINUTES * 60, SCHEDULE_MAX_MINUTES * 60
+        if entry[4]:
+            return entry[4]
+        if not isinstance(result, dict) or result['status_code'] != 200:
+            # 失效链接按连续失败次数指数退避
+            return min(base * 2 ** (entry[3] - 1), high)
+        traffic = result['traffic']
+        if traffic is None:
+            return min(base * 2, high)
+        remaining_gb, expire_days = alert_engine.thresholds(sub.id)
+        if remaining_gb and traffic.remaining < remaining_gb * 2 * 1024 ** 3:
+            return low
+        if traffic.expire is not None and traffic.expire - now < max(expire_days or 0, 1) * 2 * 86400:
+            return low
+        if traffic.total and traffic.remaining > traffic.total / 2 and (
+                traffic.expire is None or traffic.expire - now > 30 * 86400):
+            # 状态良好，逐次放宽
+            return min(max(entry[2], base) * 3 // 2, high)
+        return base
+
+    def observe(self, subscriptions: list, results: list, now: float = None):
+        """记录一批检查结果（后台或手动 /check 均可），安排下一次检查并一次性写入数据库"""
+        now = now if now is not None else time.time()
+        observed = []
+        for sub, result in zip(subscriptions, results):
+            entry = self._entries.get(sub.id)
+            if entry is None:
+                continue
+            failed = not isinstance(result, dict) or result['status_code'] != 200
+            entry[3] = entry[3] + 1 if failed else 0
+            entry[2] = self.next_interval(sub, result, entry, now)
+            entry[1] = int(now) + self.jitter(entry[2])
+            observed.append(sub.id)
+        if observed:
+            self._save(observed)
+
+    def set_fixed_interval(self, sub_id: int, minutes, now: float = None):
+        """设置固定检查间隔（分钟），None 表示恢复自适应"""
+        entry = self._entries.get(sub_id)
+        if entry is None:
+            return
+        now = int(now if now is not None else time.time())
+        entry[4] = minutes * 60 if minutes else None
+        entry[2] = entry[4] or SCHEDULE_BASE_MINUTES * 60
+        entry[1] = min(entry[1], now + self.jitter(entry[2]))
+        self._save([sub_id])
+
+    def entry(self, sub_id: int):
+        """返回 (下次检查时间, 当前间隔秒数, 连续失败次数, 是否固定间隔)"""
+        entry = self._entries.get(sub_id)
+        if entry is None:
+            return None
+        return entry[1], entry[2], entry[3], entry[4] is not None
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务：同步订阅列表并检查所有到期的订阅，结果写入历史并触发告警"""
+        if self._running:
+            return
+        self._running = True
+        try:
+            subscriptions = subscription_manager.subscriptions
+            self.sync(subscriptions)
+            due = self.due(subscriptions)
+            if not due:
+                return
+            results = await gather_in_order(
+                lambda sub: fetch_userinfo_shared(sub.url, CLASH_HEADERS),
+                due
+            )
+            self.checked += len(due)
+            alerts = record_check_results(due, results)
+            await deliver_alerts(context.bot, alerts)
         except Exception as e:
-            print(f"解析过程出错: {str(e)}")
-            return {'error': f"解析失败: {str(e)}"}
-
-    def check_all_subscriptions(self) -> list:
-        results = []
-        for sub in self.subscriptions:
-            result = self.check_subscription(sub['name'], sub['url'])
-            if 'custom_message' in sub and sub['custom_message']:
-                result['custom_message'] = sub['custom_message']
-            results.append(result)
-        return results
-
-# ------------------ 订阅实例 ------------------
-subscription_manager = SubscriptionManager()
+            logging.error(f"后台检查订阅失败: {str(e)}")
+        finally:
+            self._running = False
+
+check_scheduler = None  # 由 init_services() 创建
+
+def record_check_results(subscriptions: list, results: list) -> list:
+    """保存一次检查的结果：写入流量历史、安排下一次后台检查，返回需要发送的告警"""
+    now = time.time()
+    samples = [
+        (sub, result['traffic']) for sub, result in zip(subscriptions, results)
+        if isinstance(result, dict) and result['traffic'] is not None
+    ]
+    traffic_history.record_many([(sub.id, traffic) for sub, traffic in samples], now)
+    check_scheduler.observe(subscriptions, results, now)
+    return [alert for sub, traffic in samples for alert in alert_engine.evaluate(sub, traffic, now)]
 
-# ------------------ 机器人命令 ------------------
+async def deliver_alerts(bot, alerts: list):
+    """将告警合并为一条消息发送给管理员或 chat_ids 中的群组，告警消息不会自动删除
 
-async def delete_message_after_delay(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay: int = 60):
-    """延迟删除消息"""
-    await asyncio.sleep(delay)
+    至少一个接收者收到全部内容才算送达；未送达的告警不进入冷却，下次检查时重新发送。
+    """
+    if not alerts:
+        return
+    delivered = False
     try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception as e:
-        logging.error(f"删除消息失败: {str(e)}")
-
-async def send_message(context: ContextTypes.DEFAULT_TYPE, text: str, chat_id: int = None):
-    """发送消息并在60秒后删除"""
-    if chat_id is None:
-        # 如果未指定chat_id，则发送到所有群组
-        if CHAT_IDS:  # 只有在配置了chat_ids时才发送到所有群组
-            for cid in CHAT_IDS:
+        if ALERT_TARGET == 'groups' and CHAT_IDS:
+            targets = list(CHAT_IDS)
+        elif ADMIN_ID:
+            targets = [ADMIN_ID]
+        else:
+            logging.warning(f"未配置告警接收者，{len(alerts)} 条告警未发送")
+            return
+        pages = split_into_pages([f"⚠️ {text}" for _, text in alerts], header="订阅告警：\n\n")
+
+        async def deliver(chat_id):
+            for page in pages:
                 try:
-                    message = await context.bot.send_message(
-                        chat_id=cid, 
-                        text=text,
-                        parse_mode='HTML'
-                    )
-                    # 启动异步任务删除消息
-                    asyncio.create_task(delete_message_after_delay(context, cid, message.message_id))
+                    await message_dispatcher.send(bot, chat_id, page, parse_mode='HTML')
                 except Exception as e:
-                    logging.error(f"发送消息到群组 {cid} 失败: {str(e)}")
-        else:
-            # 如果没有配置chat_ids，则发送到当前聊天
+                    logging.error(f"发送告警到 {chat_id} 失败: {str(e)}")
+                    return False
+            return True
+
+        results = await message_dispatcher.fan_out(targets, deliver)
+        delivered = any(result is True for result in results)
+    finally:
+        alert_engine.settle(alerts, delivered)
+
+# ------------------ 分页报告 ------------------
+MESSAGE_LIMIT = 4000  # 单条消息的文本长度上限（Telegram 为 4096，留出余量）
+
+def split_into_pages(entries: list, header: str = "", separator: str = "\n", limit: int = MESSAGE_LIMIT) -> list:
+    """按条目边界将已转义的报告拆分为多页，保证每页不超过 limit
+
+    单个条目超长时再按行拆分，因此转义序列和 HTML 标签不会被截断（单行本身超长除外）。
+    """
+    pages = []
+    current = header
+    for entry in entries:
+        pieces = [entry]
+        if len(header) + len(entry) + len(separator) > limit:
+            pieces = [line + "\n" for line in entry.rstrip("\n").split("\n")]
+        pieces[-1] += separator
+        for piece in pieces:
+            if current != header and len(current) + len(piece) > limit:
+                pages.append(current)
+                current = header
+            current += piece
+    if current != header or not pages:
+        pages.append(current)
+    return pages
+
+class ReportCache:
+    """缓存分页报告，翻页时直接读取缓存而不重新请求订阅"""
+
+    def __init__(self, max_reports: int = 64, ttl: int = 3600):
+        self.max_reports = max_reports
+        self.ttl = ttl
+        self._reports = OrderedDict()
+
+    def add(self, chat_id: int, pages: list, parse_mode: str) -> str:
+        report_id = secrets.token_hex(4)
+        self._reports[report_id] = {
+            'chat_id': chat_id,
+            'pages': pages,
+            'parse_mode': parse_mode,
+            'expires_at': time.time() + self.ttl
+        }
+        while len(self._reports) > self.max_reports:
+            self._reports.popitem(last=False)
+        return report_id
+
+    def get(self, report_id: str, chat_id: int):
+        report = self._reports.get(report_id)
+        if report is None or report['expires_at'] < time.time() or report['chat_id'] != chat_id:
+            return None
+        return report
+
+report_cache = ReportCache()
+
+def page_markup(report_id: str, page: int, total: int):
+    """生成翻页按钮，只有一页时返回 None"""
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ 上一页", callback_data=f"page:{report_id}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data="page:noop"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("下一页 ▶", callback_data=f"page:{report_id}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+def paginate_report(chat_id: int, pages: list, parse_mode: str):
+    """缓存报告并返回第一页的 (文本, 翻页按钮)"""
+    if len(pages) <= 1:
+        return pages[0], None
+    report_id = report_cache.add(chat_id, pages, parse_mode)
+    return pages[0], page_markup(report_id, 0, len(pages))
+
+# ------------------ 消息发送 ------------------
+class RateBudget:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 burst 个，令牌不足时等待"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            # 在事件循环中创建，兼容 Python 3.8/3.9 的事件循环绑定
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 1
+                self._updated = time.monotonic()
+            self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """被 Telegram 限流后清空令牌，seconds 秒内不再发送"""
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+class MessageDispatcher:
+    """所有发往 Telegram 的请求经由此处：限制并发数，按全局和单个聊天的速率预算排队，
+    遇到 RetryAfter 按要求等待后重试，网络错误按指数退避重试，并按聊天统计发送结果"""
+
+    MAX_CHATS = 1024
+
+    def __init__(self, concurrency: int, rate: float):
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._global = RateBudget(rate, rate)
+        self._chats = OrderedDict()  # chat_id -> RateBudget
+        self.metrics = OrderedDict()  # chat_id -> {'sent', 'failed', 'retried', 'limited', 'error'}
+
+    def _budget(self, chat_id) -> RateBudget:
+        key = str(chat_id)
+        budget = self._chats.get(key)
+        if budget is None:
+            # 群组 id 为负数，速率限制比私聊严格
+            rate = SEND_GROUP_RATE if key.startswith('-') else SEND_CHAT_RATE
+            budget = self._chats[key] = RateBudget(rate, SEND_CHAT_BURST)
+            while len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(key)
+        return budget
+
+    def _metric(self, chat_id) -> dict:
+        key = str(chat_id)
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = {'sent': 0, 'failed': 0, 'retried': 0, 'limited': 0, 'error': None}
+            while len(self.metrics) > self.MAX_CHATS:
+                self.metrics.popitem(last=False)
+        return metric
+
+    async def call(self, target, func, *args, chat_budget: bool = True, **kwargs):
+        """以聊天 target 的速率预算执行 func(*args, **kwargs)，重试耗尽或请求无效时抛出异常
+
+        chat_budget 为 False 时只受全局预算限制，用于删除消息等不计入单个聊天发送限制的请求。
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        budget = self._budget(target) if chat_budget else None
+        metric = self._metric(target)
+        for attempt in range(SEND_RETRIES + 1):
+            if budget is not None:
+                await budget.acquire()
+            await self._global.acquire()
             try:
-                message = await context.bot.send_message(
-                    chat_id=context.effective_chat.id, 
-                    text=text,
-                    parse_mode='HTML'
-                )
-                # 启动异步任务删除消息
-                asyncio.create_task(delete_message_after_delay(context, context.effective_chat.id, message.message_id))
+                async with self._semaphore:
+                    result = await func(*args, **kwargs)
+                metric['sent'] += 1
+                return result
+            except RetryAfter as e:
+                metric['limited'] += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                if budget is not None:
+                    budget.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                error = e
+            except NetworkError as e:
+                # BadRequest 等请求本身的错误重试也不会成功
+                if isinstance(e, BadRequest):
+                    metric['failed'] += 1
+                    metric['error'] = str(e)
+                    raise
+                await asyncio.sleep(min(FETCH_BACKOFF * 2 ** attempt, FETCH_BACKOFF_MAX))
+                error = e
             except Exception as e:
-                logging.error(f"发送消息失败: {str(e)}")
-    else:
+                metric['failed'] += 1
+                metric['error'] = str(e)
+                raise
+            if attempt < SEND_RETRIES:
+                metric['retried'] += 1
+        metric['failed'] += 1
+        metric['error'] = str(error)
+        raise error
+
+    async def send(self, bot, chat_id, text: str, **kwargs):
+        return await self.call(chat_id, bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+    async def delete(self, bot, chat_id, message_id: int):
+        # Telegram 对群组每分钟 20 条的限制只针对发送，删除消息不占用聊天的发送预算
+        return await self.call(chat_id, bot.delete_message, chat_id=chat_id, message_id=message_id, chat_budget=False)
+
+    async def fan_out(self, chat_ids: list, func) -> list:
+        """对每个聊天并发执行 func(chat_id)（应通过 call/send 发送），按顺序返回结果或异常"""
+        return await asyncio.gather(*(func(chat_id) for chat_id in chat_ids), return_exceptions=True)
+
+    def totals(self) -> dict:
+        totals = {'sent': 0, 'failed': 0, 'retried': 0, 'limited': 0}
+        for metric in self.metrics.values():
+            for key in totals:
+                totals[key] += metric[key]
+        return totals
+
+message_dispatcher = None  # 由 init_services() 创建
+
+class DeletionQueue:
+    """待删除消息队列：按删除时间排列的最小堆，同时保存在数据库中
+
+    新加入的消息先缓存在内存，由定时任务每 DELETE_TICK 秒统一处理：先写入新消息，再删除到期消息，
+    最后在一个事务中移除已处理的记录。重启后从数据库恢复，已过期的消息在第一次处理时删除。
+    """
+
+    def __init__(self, store: SubscriptionStore):
+        self._heap = []
+        self._new = []
+        self._attempts = {}  # (chat_id, message_id) -> 已失败的次数
+        self._running = False
+        self.deleted = 0
+        self.failed = 0
+        self.conn, self._lock = store.attach("""
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                chat_id TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                due REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+        """)
+        self._heap = [(due, chat_id, message_id) for chat_id, message_id, due in
+                      self.conn.execute("SELECT chat_id, message_id, due FROM pending_deletions")]
+        heapq.heapify(self._heap)
+
+    def schedule(self, chat_id, message_id: int, delay: float = DELETE_DELAY):
+        """安排在 delay 秒后删除消息"""
+        entry = (time.time() + delay, str(chat_id), message_id)
+        heapq.heappush(self._heap, entry)
+        self._new.append(entry)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _save_new(self):
+        new, self._new = self._new, []
+        if not new:
+            return
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pending_deletions (chat_id, message_id, due) VALUES (?, ?, ?)",
+                [(chat_id, message_id, due_at) for due_at, chat_id, message_id in new]
+            )
+
+    async def drain(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务：保存新加入的消息，并经由 MessageDispatcher 删除所有到期的消息"""
+        # 先写入新消息再删除：上一轮删除耗时较长时新消息也会及时保存，重启后不会丢失
+        self._save_new()
+        if self._running:
+            return
+        self._running = True
         try:
-            message = await context.bot.send_message(
-                chat_id=chat_id, 
-                text=text,
-                parse_mode='HTML'
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+
+            results = await asyncio.gather(
+                *(message_dispatcher.delete(context.bot, chat_id, message_id) for _, chat_id, message_id in due),
+                return_exceptions=True
+            )
+            done, retry = [], []
+            for (_, chat_id, message_id), result in zip(due, results):
+                key = (chat_id, message_id)
+                if not isinstance(result, Exception):
+                    self.deleted += 1
+                    self._attempts.pop(key, None)
+                    done.append(key)
+                    continue
+                attempts = self._attempts.get(key, 0) + 1
+                # 限流和网络错误在 MessageDispatcher 重试耗尽后放回队列，按指数退避稍后再试；
+                # 消息已被删除或超过 48 小时（BadRequest）等无法恢复的错误记录后丢弃
+                transient = isinstance(result, RetryAfter) or (
+                    isinstance(result, NetworkError) and not isinstance(result, BadRequest))
+                if transient and attempts <= DELETE_RETRIES:
+                    self._attempts[key] = attempts
+                    entry = (time.time() + min(DELETE_TICK * 2 ** attempts, DELETE_BACKOFF_MAX), chat_id, message_id)
+                    heapq.heappush(self._heap, entry)
+                    retry.append(entry)
+                    logging.warning(f"删除消息 {chat_id}/{message_id} 失败，第 {attempts} 次重试: {str(result)}")
+                    continue
+                self.failed += 1
+                self._attempts.pop(key, None)
+                done.append(key)
+                logging.error(f"删除消息 {chat_id}/{message_id} 失败: {str(result)}")
+
+            with self._lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO pending_deletions (chat_id, message_id, due) VALUES (?, ?, ?)",
+                    [(chat_id, message_id, due_at) for due_at, chat_id, message_id in retry]
+                )
+                self.conn.executemany(
+                    "DELETE FROM pending_deletions WHERE chat_id = ? AND message_id = ?",
+                    done
+                )
+        finally:
+            self._running = False
+
+deletion_queue = None  # 由 init_services() 创建
+
+def schedule_deletion(chat_id, message_id: int, delay: float = DELETE_DELAY):
+    """安排删除机器人发送的消息（默认60秒后）"""
+    deletion_queue.schedule(chat_id, message_id, delay)
+
+# ------------------ 更新处理 ------------------
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """并发处理更新：同一聊天的更新按到达顺序逐个处理，不同聊天之间并发
+
+    最多 workers 个更新同时执行；limits 中的耗时命令（如 /check、/sub）另有各自的并发上限，
+    等待名额时不占用工作名额，因此总能给 /help、/list 等轻量命令留出处理能力。
+    """
+
+    def __init__(self, workers: int, limits: dict, backlog: int = UPDATE_BACKLOG):
+        # 基类的信号量只限制进入处理器的更新数，真正的并发数由 workers 控制，
+        # 避免同一聊天排队等待的更新占满名额
+        super().__init__(max(backlog, workers))
+        self.workers = workers
+        self.limits = {command: limit for command, limit in limits.items() if limit > 0}
+        self._workers = None
+        self._command_slots = {}
+        self._tails = {}  # chat_id -> 该聊天最后一个更新处理完成的事件
+        self.running = 0
+        self.waiting = 0
+        self.processed = 0
+        self.command_running = dict.fromkeys(self.limits, 0)
+
+    async def initialize(self):
+        # 在事件循环中创建，兼容 Python 3.8/3.9 的事件循环绑定
+        self._workers = asyncio.Semaphore(self.workers)
+        self._command_slots = {command: asyncio.Semaphore(limit) for command, limit in self.limits.items()}
+        self._tails = {}
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def command_of(update) -> str:
+        """返回消息中的命令名（不含 / 和 @机器人名），不是命令时返回空字符串"""
+        message = update.effective_message if isinstance(update, Update) else None
+        text = message and (message.text or message.caption)
+        if not text or not text.startswith('/'):
+            return ""
+        return text[1:].split(None, 1)[0].split('@', 1)[0].lower() if len(text) > 1 else ""
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        key = chat.id if chat else None
+        previous = self._tails.get(key) if key is not None else None
+        finished = asyncio.Event()
+        if key is not None:
+            self._tails[key] = finished
+        started = False
+        self.waiting += 1
+        try:
+            if previous is not None:
+                await previous.wait()
+            command = self.command_of(update)
+            slot = self._command_slots.get(command)
+            # 先取得命令名额再占用工作名额，排队的耗时命令不会挤占轻量命令
+            if slot is None:
+                async with self._workers:
+                    started = True
+                    await self._run(coroutine, None)
+            else:
+                async with slot, self._workers:
+                    started = True
+                    await self._run(coroutine, command)
+        finally:
+            if not started:
+                # 等待期间被取消（如停止机器人），协程未开始执行
+                self.waiting -= 1
+                coroutine.close()
+            finished.set()
+            if key is not None and self._tails.get(key) is finished:
+                del self._tails[key]
+
+    async def _run(self, coroutine, command):
+        self.waiting -= 1
+        self.running += 1
+        if command:
+            self.command_running[command] += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+            if command:
+                self.command_running[command] -= 1
+
+# ------------------ 机器人命令 ------------------
+
+async def send_message(context: ContextTypes.DEFAULT_TYPE, text: str, chat_id: int = None, reply_markup=None):
+    """发送消息并在60秒后删除，未指定 chat_id 时并发发送到所有群组"""
+    targets = [chat_id] if chat_id is not None else list(CHAT_IDS)
+    if not targets:
+        logging.error("发送消息失败: 未指定聊天且未配置 chat_ids")
+        return
+
+    async def deliver(cid):
+        try:
+            message = await message_dispatcher.send(
+                context.bot, cid, text,
+                parse_mode='HTML',
+                reply_markup=reply_markup
             )
-            # 启动异步任务删除消息
-            asyncio.create_task(delete_message_after_delay(context, chat_id, message.message_id))
         except Exception as e:
-            logging.error(f"发送消息失败: {str(e)}")
+            logging.error(f"发送消息到 {cid} 失败: {str(e)}")
+            return
+        schedule_deletion(cid, message.message_id)
+
+    await message_dispatcher.fan_out(targets, deliver)
 
 def escape_html(text: str) -> str:
     """转义 HTML 特殊字符"""
@@ -455,7 +1974,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add <名称> <URL> [备注] - 添加订阅\n"
         "/remove <名称> - 删除订阅\n"
         "/list - 列出所有订阅\n"
-        "/check - 检查所有订阅状态\n"
+        "/check [force] - 检查所有订阅状态\n"
         "/message <名称> <备注> - 更新订阅备注\n"
         "/setchecktime <小时> - 设置每日定时检查时间（0-23）"
     )
@@ -498,7 +2017,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "4. 查看所有订阅：\n"
             "   /list\n\n"
             "5. 检查订阅状态：\n"
-            "   /check\n\n"
+            "   /check\n"
+            "   /check force - 跳过缓存强制重新检查\n\n"
             "6. 更新订阅备注：\n"
             "   /message 名称 新备注\n"
             "   例如：/message 机场1 这是新备注\n\n"
@@ -514,6 +2034,26 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "10. 查看群组列表：\n"
             "    /listgroups\n"
             "    显示所有已添加的群组\n\n"
+            "11. 查看运行状态：\n"
+            "    /stats\n"
+            "    显示网络请求线程池等运行指标\n\n"
+            "12. 批量导入订阅：\n"
+            "    发送文件并以 /import 作为说明，或回复文件发送 /import\n"
+            "    支持 JSON、CSV（名称,链接,备注）和每行一个链接的文本\n"
+            "    /import check - 导入后检查新增的订阅\n\n"
+            "13. 导出订阅：\n"
+            "    /export [json|csv]\n\n"
+            "14. 查看流量历史：\n"
+            "    /history &lt;名称&gt; [天数]\n"
+            "    显示每日用量、日均消耗和预计用完时间，默认最近14天\n\n"
+            "15. 设置告警阈值：\n"
+            "    /alert - 查看当前阈值\n"
+            "    /alert global &lt;GB&gt; &lt;天数&gt; - 设置全局阈值\n"
+            "    /alert &lt;名称&gt; &lt;GB&gt; &lt;天数&gt; - 单独设置订阅阈值（- 沿用全局，0 不告警）\n"
+            "    /alert &lt;名称&gt; reset - 恢复使用全局阈值\n\n"
+            "16. 后台检查计划：\n"
+            "    /schedule - 查看每个订阅的下次检查时间和间隔\n"
+            "    /schedule &lt;名称&gt; &lt;分钟|auto&gt; - 设置固定间隔或恢复自适应\n\n"
             "所有用户可用命令：\n"
             "1. 检查订阅链接：\n"
             "   /sub &lt;链接&gt;\n"
@@ -570,7 +2110,10 @@ async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     name = context.args[0]
-    if subscription_manager.remove_subscription(name):
+    sub = subscription_manager.get_subscription(name)
+    if sub is not None and subscription_manager.remove_subscription(name):
+        traffic_history.forget(sub.id)
+        alert_engine.forget(sub.id)
         await send_message(context, f"订阅 {name} 已删除！", update.effective_chat.id)
     else:
         await send_message(context, f"订阅 {name} 不存在！", update.effective_chat.id)
@@ -587,13 +2130,15 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_message(context, "当前没有订阅！", update.effective_chat.id)
         return
 
-    text = "当前订阅列表：\n\n"
+    entries = []
     for sub in subscriptions:
-        text += f"名称：{escape_html(sub['name'])}\n"
-        text += f"URL：<tg-spoiler>{escape_html(sub['url'])}</tg-spoiler>\n"
-        if sub.get("custom_message"):
-            text += f"备注：{escape_html(sub['custom_message'])}\n"
-        text += "-------------------\n"
+        entry = f"名称：{escape_html(sub.name)}\n"
+        entry += f"URL：<tg-spoiler>{escape_html(sub.url)}</tg-spoiler>\n"
+        if sub.custom_message:
+            entry += f"备注：{escape_html(sub.custom_message)}\n"
+        entry += "-------------------\n"
+        entries.append(entry)
+    pages = split_into_pages(entries, header="当前订阅列表：\n\n", separator="")
     
     # 如果在群组中使用，发送到私聊
     if update.effective_chat.type in ['group', 'supergroup']:
@@ -601,106 +2146,225 @@ async def list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # 先发送提示消息到群组
             await send_message(context, "已将订阅列表发送到私聊，请查看与机器人的私聊消息。", update.effective_chat.id)
             # 然后发送完整列表到私聊
+            text, markup = paginate_report(update.effective_user.id, pages, 'HTML')
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
                 text=text,
-                parse_mode='HTML'
+                parse_mode='HTML',
+                reply_markup=markup
             )
         except Exception as e:
             logging.error(f"发送私聊消息失败: {str(e)}")
             await send_message(context, "无法发送私聊消息，请先与机器人开始私聊。", update.effective_chat.id)
     else:
         # 在私聊中直接发送
-        await send_message(context, text, update.effective_chat.id)
-
-async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理 /check 命令"""
-    if not await group_permission_required(update, context):
-        return
-    if not await admin_required(update, context):
-        return
+        text, markup = paginate_report(update.effective_chat.id, pages, 'HTML')
+        await send_message(context, text, update.effective_chat.id, reply_markup=markup)
+
+class ProgressMessage:
+    """合并频繁的进度更新：内容变化后最多每 PROGRESS_EDIT_INTERVAL 秒编辑一次消息"""
+
+    def __init__(self, bot, chat_id: int, message_id: int, parse_mode: str = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.parse_mode = parse_mode
+        self._text = None
+        self._shown = None
+        self._next_edit = 0
+        self._flush_task = None
+
+    def update(self, text: str):
+        """记录最新内容，由后台任务在允许的时间点统一编辑"""
+        self._text = text
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            while self._text != self._shown:
+                await asyncio.sleep(max(0, self._next_edit - time.monotonic()))
+                await self._edit(self._text)
+        finally:
+            self._flush_task = None
 
+    async def _edit(self, text: str):
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+                parse_mode=self.parse_mode
+            )
+        except RetryAfter as e:
+            # 被限流时推迟下一次编辑，内容保持待更新
+            self._next_edit = time.monotonic() + e.retry_after
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logging.error(f"更新进度消息失败: {str(e)}")
+        except TelegramError as e:
+            # 超时、网络错误等：放弃这次编辑，等下一次进度变化时再更新
+            logging.error(f"更新进度消息失败: {str(e)}")
+        self._shown = text
+        self._next_edit = time.monotonic() + PROGRESS_EDIT_INTERVAL
+
+    async def finish(self, text: str, reply_markup=None):
+        """取消未执行的进度编辑，写入最终内容"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        while True:
+            await asyncio.sleep(max(0, self._next_edit - time.monotonic()))
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    text=text,
+                    parse_mode=self.parse_mode,
+                    reply_markup=reply_markup
+                )
+                return
+            except RetryAfter as e:
+                self._next_edit = time.monotonic() + e.retry_after
+
+def format_check_progress(done: int, total: int, sections: list) -> str:
+    """按完成顺序展示已完成的订阅，超出消息长度时只保留最近完成的部分"""
+    header = escape_markdown(f"正在检查订阅 {done}/{total}...") + "\n\n"
+    body = ""
+    for section in reversed(sections):
+        if len(header) + len(section) + len(body) + 2 > MESSAGE_LIMIT:
+            break
+        body = section + "\n\n" + body
+    return header + body
+
+def format_traffic_markdown(traffic: TrafficInfo) -> str:
+    """将流量信息格式化为 MarkdownV2 文本：已用上行/下行、剩余、总共和到期时间"""
+    text = (
+        f'已用上行：{escape_markdown(StrOfSize(traffic.upload))}\n'
+        f'已用下行：{escape_markdown(StrOfSize(traffic.download))}\n'
+        f'剩余：{escape_markdown(StrOfSize(traffic.remaining))}\n'
+        f'总共：{escape_markdown(StrOfSize(traffic.total))}'
+    )
+    if traffic.expire is None:
+        return f"{text}\n到期时间：未知"
+
+    time_now = int(time.time())
+    dateTime = traffic.expire_date()
+    if time_now <= traffic.expire:
+        lasttime = traffic.expire - time_now
+        return f"{text}\n此订阅将于 {escape_markdown(dateTime)} 过期，剩余 {escape_markdown(sec_to_data(lasttime))}"
+    return f"{text}\n此订阅已于 {escape_markdown(dateTime)} 过期！"
+
+def format_check_entry(sub: Subscription, result) -> str:
+    """将单个订阅的抓取结果格式化为 MarkdownV2 文本"""
+    airport_name = escape_markdown(sub.name)
+    if isinstance(result, asyncio.TimeoutError):
+        return f'订阅：{airport_name}\n检查超时'
+    if isinstance(result, Exception):
+        return f'订阅：{airport_name}\n连接错误'
+
+    if result['status_code'] != 200:
+        output_text = f'订阅：{airport_name}\n无法访问'
+    elif result['traffic'] is None:
+        output_text = f'订阅：{airport_name}\n无流量信息'
+    else:
+        output_text = f'订阅：{airport_name}\n' + format_traffic_markdown(result['traffic'])
+
+    if sub.custom_message:
+        output_text += f"\n备注：{escape_markdown(sub.custom_message)}"
+    return output_text
+
+async def run_check(subscriptions: list, force: bool = False, on_result=None):
+    """检查引擎：并发抓取、保存结果并渲染一次报告，不依赖 Update
+
+    /check、/import check 和每日定时检查共用此流程。返回 (报告分页, 告警列表)，
+    报告为 MarkdownV2 文本，可直接发送到任意数量的聊天。
+    """
+    run_stats = TransferStats(parent=transfer_stats)
+    results = await gather_in_order(
+        lambda sub: fetch_userinfo_shared(sub.url, CLASH_HEADERS, force=force, stats=run_stats),
+        subscriptions,
+        on_result
+    )
+    logging.info(f"检查 {len(subscriptions)} 个订阅完成：{run_stats.summary()}")
+    if subscriptions:
+        entries = [format_check_entry(sub, result) for sub, result in zip(subscriptions, results)]
+        pages = split_into_pages(entries, separator='\n\n')
+    else:
+        pages = [escape_markdown("当前没有订阅！")]
+    # 返回的告警由调用方交给 deliver_alerts()，之间不应再有可能出错的步骤
+    alerts = record_check_results(subscriptions, results)
+    return pages, alerts
+
+async def check_and_report(context: ContextTypes.DEFAULT_TYPE, chat_id: int, subscriptions: list,
+                           force: bool = False, title: str = "开始检查所有订阅..."):
+    """并发检查给定订阅，在一条消息中实时显示进度并最终展示（分页的）报告"""
     # 发送初始消息并保存消息ID
     message = await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="开始检查所有订阅..."
+        chat_id=chat_id,
+        text=title
     )
     message_id = message.message_id
 
-    final_output = ''
-    headers = {
-        'User-Agent': 'ClashforWindows/0.18.1'
-    }
+    progress = ProgressMessage(context.bot, chat_id, message_id, parse_mode='MarkdownV2')
+    sections = []
 
-    for sub in subscription_manager.subscriptions:
-        url = sub['url']
-        try:
-            res = requests.get(url, headers=headers, timeout=5)
-            while res.status_code in [301, 302]:
-                url = res.headers['location']
-                res = requests.get(url, headers=headers, timeout=5)
-        except:
-            final_output += f'订阅：{escape_markdown(sub["name"])}\n连接错误\n\n'
-            continue
+    def on_result(index, result):
+        # 进度按完成顺序追加，最终结果仍按订阅列表顺序排列
+        sections.append(format_check_entry(subscriptions[index], result))
+        progress.update(format_check_progress(len(sections), len(subscriptions), sections))
 
-        if res.status_code == 200:
-            try:
-                info = res.headers['subscription-userinfo']
-                info_num = re.findall(r'\d+', info)
-                time_now = int(time.time())
-                
-                # 转义所有特殊字符
-                safe_url = escape_markdown(url)
-                airport_name = escape_markdown(sub["name"])
-                upload = escape_markdown(StrOfSize(int(info_num[0])))
-                download = escape_markdown(StrOfSize(int(info_num[1])))
-                remaining = escape_markdown(StrOfSize(int(info_num[2]) - int(info_num[1]) - int(info_num[0])))
-                total = escape_markdown(StrOfSize(int(info_num[2])))
-                
-                output_text_head = (
-                    f'订阅：{airport_name}\n'
-                    f'已用上行：{upload}\n'
-                    f'已用下行：{download}\n'
-                    f'剩余：{remaining}\n'
-                    f'总共：{total}'
-                )
-                
-                if len(info_num) >= 4:
-                    timeArray = time.localtime(int(info_num[3]) + 28800)
-                    dateTime = time.strftime("%Y-%m-%d", timeArray)
-                    if time_now <= int(info_num[3]):
-                        lasttime = int(info_num[3]) - time_now
-                        output_text = f"{output_text_head}\n此订阅将于 {escape_markdown(dateTime)} 过期，剩余 {escape_markdown(sec_to_data(lasttime))}"
-                    else:
-                        output_text = f"{output_text_head}\n此订阅已于 {escape_markdown(dateTime)} 过期！"
-                else:
-                    output_text = f"{output_text_head}\n到期时间：未知"
-
-                if sub.get('custom_message'):
-                    output_text += f"\n备注：{escape_markdown(sub['custom_message'])}"
-            except:
-                safe_url = escape_markdown(url)
-                airport_name = escape_markdown(sub["name"])
-                output_text = f'订阅：{airport_name}\n无流量信息'
-                if sub.get('custom_message'):
-                    output_text += f"\n备注：{escape_markdown(sub['custom_message'])}"
-        else:
-            output_text = f'订阅：{escape_markdown(sub["name"])}\n无法访问'
-            if sub.get('custom_message'):
-                output_text += f"\n备注：{escape_markdown(sub['custom_message'])}"
-        
-        final_output += output_text + '\n\n'
+    pages, alerts = await run_check(subscriptions, force, on_result)
 
-    # 更新消息内容
-    await context.bot.edit_message_text(
-        chat_id=update.effective_chat.id,
-        message_id=message_id,
-        text=final_output,
-        parse_mode='MarkdownV2'
-    )
+    # 更新消息内容，超出长度的报告以翻页按钮展示
+    text, markup = paginate_report(chat_id, pages, 'MarkdownV2')
+    try:
+        await progress.finish(text, markup)
+    finally:
+        # 报告消息编辑失败（如已被删除）也要发送告警
+        await deliver_alerts(context.bot, alerts)
 
     # 60秒后删除消息
-    asyncio.create_task(delete_message_after_delay(context, update.effective_chat.id, message_id))
+    schedule_deletion(chat_id, message_id)
+
+async def send_report(context: ContextTypes.DEFAULT_TYPE, chat_id, pages: list):
+    """将已渲染的报告发送到一个聊天，60秒后删除"""
+    # chat_ids 和 admin_id 在配置中是字符串，翻页时按回调中的整数 id 校验
+    text, markup = paginate_report(int(chat_id), pages, 'MarkdownV2')
+    try:
+        message = await message_dispatcher.send(
+            context.bot, chat_id, text,
+            parse_mode='MarkdownV2',
+            reply_markup=markup
+        )
+    except Exception as e:
+        logging.error(f"发送检查报告到 {chat_id} 失败: {str(e)}")
+        return
+    schedule_deletion(chat_id, message.message_id)
+
+async def scheduled_check(context: ContextTypes.DEFAULT_TYPE):
+    """每日定时检查：不依赖 Update，检查全部订阅后把同一份报告发送到所有 chat_ids 群组
+
+    没有配置群组时发送给管理员。
+    """
+    targets = list(CHAT_IDS) or ([ADMIN_ID] if ADMIN_ID else [])
+    if not targets:
+        logging.warning("未配置 chat_ids 和 admin_id，定时检查的报告无处发送")
+    pages, alerts = await run_check(subscription_manager.subscriptions)
+    await message_dispatcher.fan_out(targets, lambda chat_id: send_report(context, chat_id, pages))
+    await deliver_alerts(context.bot, alerts)
+
+async def check_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /check 命令"""
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    # /check force 跳过缓存，强制重新请求所有订阅
+    force = bool(context.args) and context.args[0].lower() == 'force'
+    await check_and_report(context, update.effective_chat.id, subscription_manager.subscriptions, force)
 
 async def message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /message 命令"""
@@ -737,12 +2401,23 @@ async def set_check_time_command(update: Update, context: ContextTypes.DEFAULT_T
         if 0 <= hour <= 23:
             config["check_hour"] = hour
             save_config(config)
+            schedule_daily_check(context.job_queue, hour)
             await send_message(context, f"检查时间已设置为 {hour}:00", update.effective_chat.id)
         else:
             await send_message(context, "时间必须在 0-23 之间！", update.effective_chat.id)
     except ValueError:
         await send_message(context, "请输入有效的时间！", update.effective_chat.id)
 
+def schedule_daily_check(job_queue, hour: int):
+    """安排（或重新安排）每日定时检查任务"""
+    for job in job_queue.get_jobs_by_name("daily_check"):
+        job.schedule_removal()
+    job_queue.run_daily(
+        scheduled_check,
+        time=dtime(hour=hour, tzinfo=TIMEZONE),
+        name="daily_check"
+    )
+
 async def sub_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /sub 命令，临时解析订阅链接"""
     if not await group_permission_required(update, context):
@@ -774,52 +2449,24 @@ async def sub_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     message_id = message.message_id
 
+    # 机场名与流量信息同时解析，解析结果按主机缓存
+    airport_name_task = asyncio.ensure_future(resolve_airport_name(url))
     try:
-        headers = {
-            'User-Agent': 'ClashforWindows/0.18.1'
-        }
-        res = requests.get(url, headers=headers, timeout=5)
-        while res.status_code in [301, 302]:
-            url = res.headers['location']
-            res = requests.get(url, headers=headers, timeout=5)
-
-        if res.status_code == 200:
-            try:
-                info = res.headers['subscription-userinfo']
-                info_num = re.findall(r'\d+', info)
-                time_now = int(time.time())
-                
-                # 转义所有特殊字符
-                safe_url = escape_markdown(url)
-                airport_name = escape_markdown(get_filename_from_url(url))
-                upload = escape_markdown(StrOfSize(int(info_num[0])))
-                download = escape_markdown(StrOfSize(int(info_num[1])))
-                remaining = escape_markdown(StrOfSize(int(info_num[2]) - int(info_num[1]) - int(info_num[0])))
-                total = escape_markdown(StrOfSize(int(info_num[2])))
-                
-                output_text_head = (
-                    f'订阅链接：{safe_url}\n'
-                    f'机场名：{airport_name}\n'
-                    f'已用上行：{upload}\n'
-                    f'已用下行：{download}\n'
-                    f'剩余：{remaining}\n'
-                    f'总共：{total}'
-                )
-                
-                if len(info_num) >= 4:
-                    timeArray = time.localtime(int(info_num[3]) + 28800)
-                    dateTime = time.strftime("%Y-%m-%d", timeArray)
-                    if time_now <= int(info_num[3]):
-                        lasttime = int(info_num[3]) - time_now
-                        output_text = f"{output_text_head}\n此订阅将于 {escape_markdown(dateTime)} 过期，剩余 {escape_markdown(sec_to_data(lasttime))}"
-                    else:
-                        output_text = f"{output_text_head}\n此订阅已于 {escape_markdown(dateTime)} 过期！"
-                else:
-                    output_text = f"{output_text_head}\n到期时间：未知"
-            except:
-                safe_url = escape_markdown(url)
-                airport_name = escape_markdown(get_filename_from_url(url))
-                output_text = f'订阅链接：{safe_url}\n机场名：{airport_name}\n无流量信息'
+        result = await fetch_userinfo_shared(url, CLASH_HEADERS)
+        url = result['url']
+
+        if result['status_code'] == 200:
+            # 转义所有特殊字符
+            safe_url = escape_markdown(url)
+            airport_name = escape_markdown(await airport_name_task)
+            output_text_head = (
+                f'订阅链接：{safe_url}\n'
+                f'机场名：{airport_name}\n'
+            )
+            if result['traffic'] is not None:
+                output_text = output_text_head + format_traffic_markdown(result['traffic'])
+            else:
+                output_text = output_text_head + '无流量信息'
         else:
             output_text = '无法访问该链接，请检查链接是否正确'
         
@@ -842,9 +2489,15 @@ async def sub_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_id=message_id,
             text=f"解析失败：{str(e)}\n请确保链接格式正确"
         )
+    finally:
+        # 链接无法访问或出错时不需要机场名，取消解析（共享的请求有 shield 保护，不受影响）
+        if not airport_name_task.done():
+            airport_name_task.cancel()
+        elif not airport_name_task.cancelled():
+            airport_name_task.exception()  # 未被等待的失败任务，避免 "exception was never retrieved"
 
     # 60秒后删除消息
-    asyncio.create_task(delete_message_after_delay(context, update.effective_chat.id, message_id))
+    schedule_deletion(update.effective_chat.id, message_id)
 
 async def add_group_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /addgroup 命令，添加群组ID"""
@@ -893,17 +2546,469 @@ async def list_groups_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await send_message(context, "当前没有添加任何群组", update.effective_chat.id)
         return
 
+    chats = await message_dispatcher.fan_out(
+        CHAT_IDS, lambda chat_id: message_dispatcher.call(chat_id, context.bot.get_chat, chat_id)
+    )
     text = "当前群组列表：\n\n"
-    for chat_id in CHAT_IDS:
-        try:
-            chat = await context.bot.get_chat(chat_id)
+    for chat_id, chat in zip(CHAT_IDS, chats):
+        if isinstance(chat, Exception):
+            text += f"ID：{escape_html(chat_id)} (无法获取群组信息)\n"
+        else:
             text += f"群组：{escape_html(chat.title)}\n"
             text += f"ID：{escape_html(chat_id)}\n"
-            text += "-------------------\n"
-        except Exception as e:
-            text += f"ID：{escape_html(chat_id)} (无法获取群组信息)\n"
-            text += "-------------------\n"
-    
+        text += "-------------------\n"
+
+    await send_message(context, text, update.effective_chat.id)
+
+IMPORT_MAX_BYTES = 5 * 1024 * 1024  # /import 接受的最大文件大小
+URL_PATTERN = re.compile(r"^https?://\S+$")
+
+def parse_import_document(filename: str, data: bytes):
+    """解析导入文件，返回 ((名称, 链接, 备注) 列表, 错误列表)
+
+    支持三种格式：
+    - JSON：[{"name", "url", "custom_message"}] 、链接字符串列表或 {名称: 链接}
+    - CSV：每行 名称,链接[,备注]，可带表头
+    - 纯文本：每行一个链接，或 "名称 链接 [备注]"（与 /add 格式相同）
+    没有名称的链接由 SubscriptionManager.add_subscriptions 按主机名生成名称。
+    """
+    text = data.decode('utf-8-sig')
+    rows = []
+    lower_name = (filename or "").lower()
+    if lower_name.endswith('.json') or text.lstrip()[:1] in ('[', '{'):
+        content = json.loads(text)
+        if isinstance(content, dict):
+            content = [{'name': name, 'url': url} for name, url in content.items()]
+        for item in content:
+            if isinstance(item, str):
+                rows.append((None, item, ""))
+            elif isinstance(item, dict):
+                rows.append((item.get('name'), item.get('url', ""), item.get('custom_message') or ""))
+            else:
+                rows.append((None, str(item), ""))
+    elif lower_name.endswith('.csv'):
+        for record in csv.reader(io.StringIO(text)):
+            if not record or not any(field.strip() for field in record):
+                continue
+            if len(record) == 1:
+                rows.append((None, record[0], ""))
+            else:
+                rows.append((record[0], record[1], ",".join(record[2:])))
+    else:
+        for line in text.splitlines():
+            parts = line.split(maxsplit=2)
+            if not parts:
+                continue
+            if len(parts) == 1:
+                rows.append((None, parts[0], ""))
+            else:
+                rows.append((parts[0], parts[1], parts[2] if len(parts) > 2 else ""))
+
+    entries = []
+    errors = []
+    for number, (name, url, custom_message) in enumerate(rows, 1):
+        url = str(url or "").strip()
+        name = str(name).strip() if name is not None else None
+        if not URL_PATTERN.match(url):
+            # CSV 表头等首行不是链接时直接忽略
+            if number > 1 or lower_name.endswith('.json'):
+                errors.append(f"第 {number} 条：无效链接 {url[:50]}")
+            continue
+        entries.append((name or None, url, str(custom_message).strip()))
+    return entries, errors
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /import 命令：从 JSON/CSV/纯文本链接列表文件批量导入订阅
+
+    将文件以 /import 为说明发送，或回复文件消息发送 /import；
+    追加参数 check 时导入后只检查新增的订阅。
+    """
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    message = update.effective_message
+    document = message.document
+    if document is None and message.reply_to_message:
+        document = message.reply_to_message.document
+    if document is None:
+        await send_message(context, "请发送订阅文件并以 /import 作为说明，或回复文件消息发送 /import [check]\n支持 JSON、CSV 和每行一个链接的文本文件", update.effective_chat.id)
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await send_message(context, "文件过大，最大支持 5MB", update.effective_chat.id)
+        return
+
+    # 作为文件说明时参数在 caption 中
+    args = context.args if context.args is not None else (message.caption or "").split()[1:]
+    check_after = any(arg.lower() == 'check' for arg in args)
+
+    try:
+        file = await context.bot.get_file(document.file_id)
+        data = bytes(await file.download_as_bytearray())
+        entries, errors = parse_import_document(document.file_name, data)
+    except Exception as e:
+        await send_message(context, f"解析导入文件失败：{escape_html(str(e))}", update.effective_chat.id)
+        return
+
+    added, skipped = subscription_manager.add_subscriptions(entries)
+    text = f"导入完成：新增 {len(added)} 个，跳过重复 {skipped} 个，无效 {len(errors)} 个"
+    if errors:
+        text += "\n\n" + "\n".join(escape_html(error) for error in errors[:10])
+        if len(errors) > 10:
+            text += f"\n……共 {len(errors)} 个错误"
+    await send_message(context, text, update.effective_chat.id)
+
+    if check_after and added:
+        await check_and_report(context, update.effective_chat.id, added, title=f"开始检查新增的 {len(added)} 个订阅...")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /export 命令：以 JSON（默认）或 CSV 文件导出所有订阅"""
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    subscriptions = subscription_manager.subscriptions
+    if not subscriptions:
+        await send_message(context, "当前没有订阅！", update.effective_chat.id)
+        return
+
+    fmt = context.args[0].lower() if context.args else 'json'
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['name', 'url', 'custom_message'])
+        for sub in subscriptions:
+            writer.writerow([sub.name, sub.url, sub.custom_message])
+        content = buffer.getvalue()
+    elif fmt == 'json':
+        content = json.dumps(
+            [{'name': sub.name, 'url': sub.url, 'custom_message': sub.custom_message} for sub in subscriptions],
+            ensure_ascii=False, indent=2
+        )
+    else:
+        await send_message(context, "格式只支持 json 或 csv，例如：/export csv", update.effective_chat.id)
+        return
+
+    filename = f"subscriptions-{datetime.now(TIMEZONE).strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    # 订阅链接属于敏感信息，在群组中使用时发送到私聊
+    target = update.effective_user.id if update.effective_chat.type in ['group', 'supergroup'] else update.effective_chat.id
+    try:
+        await context.bot.send_document(
+            chat_id=target,
+            document=content.encode('utf-8'),
+            filename=filename,
+            caption=f"共 {len(subscriptions)} 个订阅"
+        )
+        if target != update.effective_chat.id:
+            await send_message(context, "已将订阅文件发送到私聊，请查看与机器人的私聊消息。", update.effective_chat.id)
+    except Exception as e:
+        logging.error(f"导出订阅失败: {str(e)}")
+        await send_message(context, "无法发送文件，请先与机器人开始私聊。", update.effective_chat.id)
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理报告翻页按钮"""
+    query = update.callback_query
+    parts = query.data.split(':')
+    if len(parts) != 3:
+        await query.answer()
+        return
+
+    _, report_id, page = parts
+    report = report_cache.get(report_id, query.message.chat.id)
+    if report is None:
+        await query.answer("报告已过期，请重新执行命令", show_alert=True)
+        return
+
+    page = int(page)
+    await query.answer()
+    try:
+        await query.edit_message_text(
+            text=report['pages'][page],
+            parse_mode=report['parse_mode'],
+            reply_markup=page_markup(report_id, page, len(report['pages']))
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logging.error(f"翻页失败: {str(e)}")
+
+def parse_threshold(value: str):
+    """解析 /alert 的阈值参数，"-" 表示沿用全局阈值（返回 None）"""
+    if value == '-':
+        return None
+    number = float(value)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+def format_threshold(remaining_gb, expire_days) -> str:
+    traffic = f"剩余流量低于 {remaining_gb:g} GB" if remaining_gb else "剩余流量不告警"
+    expire = f"距到期不足 {expire_days:g} 天" if expire_days else "到期时间不告警"
+    return f"{traffic}，{expire}"
+
+async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /alert 命令，查看和设置告警阈值"""
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    args = context.args or []
+    if not args:
+        lines = [f"全局阈值：{format_threshold(alert_engine.remaining_gb, alert_engine.expire_days)}",
+                 f"重复提醒间隔：{alert_engine.cooldown / 3600:g} 小时"]
+        overrides = [sub for sub in subscription_manager.subscriptions if alert_engine.has_rule(sub.id)]
+        if overrides:
+            lines.append("\n单独设置的订阅：")
+            for sub in overrides:
+                lines.append(f"{escape_html(sub.name)}：{format_threshold(*alert_engine.thresholds(sub.id))}")
+        lines.append(
+            "\n设置：/alert global &lt;GB&gt; &lt;天数&gt;\n"
+            "/alert &lt;名称&gt; &lt;GB&gt; &lt;天数&gt;（- 表示沿用全局，0 表示不告警）\n"
+            "/alert &lt;名称&gt; reset"
+        )
+        await send_message(context, "\n".join(lines), update.effective_chat.id)
+        return
+
+    name = args[0]
+    if name.lower() != 'global':
+        sub = subscription_manager.get_subscription(name)
+        if sub is None:
+            await send_message(context, f"订阅 {escape_html(name)} 不存在！", update.effective_chat.id)
+            return
+        if len(args) == 2 and args[1].lower() == 'reset':
+            alert_engine.set_rule(sub.id)
+            await send_message(context, f"订阅 {escape_html(name)} 已恢复使用全局阈值", update.effective_chat.id)
+            return
+
+    if len(args) < 3:
+        await send_message(context, "格式：/alert &lt;名称|global&gt; &lt;GB&gt; &lt;天数&gt;", update.effective_chat.id)
+        return
+    try:
+        remaining_gb, expire_days = parse_threshold(args[1]), parse_threshold(args[2])
+    except ValueError:
+        await send_message(context, "阈值必须是非负数字或 -", update.effective_chat.id)
+        return
+
+    if name.lower() == 'global':
+        if remaining_gb is not None:
+            alert_engine.remaining_gb = config["alert_remaining_gb"] = remaining_gb
+        if expire_days is not None:
+            alert_engine.expire_days = config["alert_expire_days"] = expire_days
+        save_config(config)
+        text = f"全局阈值已设置为：{format_threshold(alert_engine.remaining_gb, alert_engine.expire_days)}"
+    else:
+        alert_engine.set_rule(sub.id, remaining_gb, expire_days)
+        text = f"订阅 {escape_html(name)} 的阈值已设置为：{format_threshold(*alert_engine.thresholds(sub.id))}"
+    await send_message(context, text, update.effective_chat.id)
+
+def format_interval(seconds: int) -> str:
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}小时"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}小时"
+    return f"{seconds // 60}分钟"
+
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /schedule 命令，查看后台检查计划或设置订阅的检查间隔"""
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    args = context.args or []
+    if not args:
+        subscriptions = subscription_manager.subscriptions
+        if not subscriptions:
+            await send_message(context, "当前没有订阅！", update.effective_chat.id)
+            return
+        check_scheduler.sync(subscriptions)
+        entries = []
+        for sub in subscriptions:
+            next_due, interval, failures, fixed = check_scheduler.entry(sub.id)
+            due_text = format_date(next_due, '%m-%d %H:%M')
+            entry = f"{escape_html(sub.name)}：下次 {due_text}，间隔 {format_interval(interval)}"
+            entry += "（固定）" if fixed else ""
+            entry += f"，连续失败 {failures} 次" if failures else ""
+            entries.append(entry)
+        status = "" if SCHEDULE_ENABLED else "（后台检查未启用，可在配置中设置 schedule_enabled）"
+        header = f"后台检查计划{status}：\n\n"
+        pages = split_into_pages(entries, header=header)
+        text, markup = paginate_report(update.effective_chat.id, pages, 'HTML')
+        await send_message(context, text, update.effective_chat.id, reply_markup=markup)
+        return
+
+    if len(args) < 2:
+        await send_message(context, "格式：/schedule &lt;名称&gt; &lt;分钟|auto&gt;", update.effective_chat.id)
+        return
+    name = args[0]
+    sub = subscription_manager.get_subscription(name)
+    if sub is None:
+        await send_message(context, f"订阅 {escape_html(name)} 不存在！", update.effective_chat.id)
+        return
+    if args[1].lower() == 'auto':
+        minutes = None
+    else:
+        try:
+            minutes = int(args[1])
+        except ValueError:
+            minutes = 0
+        if minutes < SCHEDULE_MIN_MINUTES:
+            await send_message(context, f"间隔必须是不小于 {SCHEDULE_MIN_MINUTES} 的整数分钟，或 auto", update.effective_chat.id)
+            return
+    check_scheduler.sync(subscription_manager.subscriptions)
+    check_scheduler.set_fixed_interval(sub.id, minutes)
+    if minutes is None:
+        await send_message(context, f"订阅 {escape_html(name)} 已恢复自适应检查间隔", update.effective_chat.id)
+    else:
+        await send_message(context, f"订阅 {escape_html(name)} 的检查间隔已设置为 {minutes} 分钟", update.effective_chat.id)
+
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+SPARKLINE_DAYS = 30  # 走势图最多显示的天数
+
+def sparkline(values: list) -> str:
+    """用方块字符绘制数值序列的走势"""
+    peak = max(values, default=0)
+    if peak <= 0:
+        return SPARK_BLOCKS[0] * len(values)
+    return "".join(SPARK_BLOCKS[min(int(value / peak * len(SPARK_BLOCKS)), len(SPARK_BLOCKS) - 1)] for value in values)
+
+def format_history_report(sub: Subscription, daily: list, rate_samples: list, now: float = None) -> list:
+    """将流量历史格式化为 HTML 分页报告：当前用量、日均消耗、预计用完时间和每日用量表"""
+    now = now if now is not None else time.time()
+    _, _, upload, download, total, expire = daily[-1]
+    traffic = TrafficInfo(upload, download, total, expire)
+    rate = burn_rate(rate_samples)
+
+    summary = (
+        f"订阅：{escape_html(sub.name)}\n"
+        f"已用：{StrOfSize(traffic.used)} / {StrOfSize(traffic.total)}，剩余 {StrOfSize(traffic.remaining)}\n"
+        f"到期时间：{traffic.expire_date()}\n"
+    )
+    if rate is None:
+        summary += "日均消耗：数据不足，需要至少相隔一小时的两次检查\n"
+    else:
+        summary += f"日均消耗（近 {BURN_RATE_DAYS} 天）：{StrOfSize(int(rate))}\n"
+        exhaust_at = project_exhaustion(traffic, rate, now)
+        if traffic.remaining <= 0:
+            summary += "流量已用完\n"
+        elif exhaust_at is None:
+            summary += "预计用完：近期没有消耗\n"
+        else:
+            exhaust_date = format_date(exhaust_at)
+            days_left = (exhaust_at - now) / 86400
+            if traffic.expire is not None and exhaust_at > traffic.expire:
+                summary += f"预计用完：{exhaust_date}（晚于到期时间，到期前不会用完）\n"
+            else:
+                summary += f"预计用完：{exhaust_date}（约 {days_left:.1f} 天后）\n"
+
+    # 每日用量为与前一个有记录日期的差值，第一天没有基准
+    used = [(row[1], row[2] + row[3]) for row in daily]
+    increments = [None] + [delta for _, delta in usage_increments(used)]
+    recent = [delta for delta in increments[1:]][-SPARKLINE_DAYS:]
+    if recent:
+        summary += f"每日用量走势（近 {len(recent)} 天）：{sparkline(recent)}\n"
+    summary += "\n"
+
+    entries = []
+    for (day, _, _, _, _, _), (_, used_bytes), delta in zip(daily, used, increments):
+        date = datetime.fromordinal(day).strftime('%m-%d')
+        change = f"+{StrOfSize(delta)}" if delta is not None else "-"
+        entries.append(f"{date}  {StrOfSize(used_bytes):>14}  {change}")
+    entries.reverse()  # 最近的日期在前
+
+    pages = split_into_pages(entries, header=summary + "<pre>", limit=MESSAGE_LIMIT - len("</pre>"))
+    return [page + "</pre>" for page in pages]
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /history 命令，显示订阅的流量历史和趋势"""
+    if not await group_permission_required(update, context):
+        return
+    if not await admin_required(update, context):
+        return
+
+    if not context.args:
+        await send_message(context, "请提供订阅名称，格式：/history &lt;名称&gt; [天数]", update.effective_chat.id)
+        return
+
+    name = context.args[0]
+    sub = subscription_manager.get_subscription(name)
+    if sub is None:
+        await send_message(context, f"订阅 {escape_html(name)} 不存在！", update.effective_chat.id)
+        return
+    try:
+        days = int(context.args[1]) if len(context.args) > 1 else 14
+    except ValueError:
+        await send_message(context, "天数必须是整数", update.effective_chat.id)
+        return
+    days = max(1, min(days, HISTORY_DAYS))
+
+    now = time.time()
+    daily = traffic_history.daily(sub.id, days, now)
+    if not daily:
+        await send_message(context, f"订阅 {escape_html(name)} 暂无流量历史，每次 /check 后会自动记录", update.effective_chat.id)
+        return
+
+    # 日均消耗优先使用小时样本，超出小时样本保留期时退回每日样本
+    since = int(now) - BURN_RATE_DAYS * 86400
+    rate_samples = [(row[0], row[1] + row[2]) for row in traffic_history.hourly(sub.id, since)]
+    if len(rate_samples) < 2:
+        rate_samples = [(row[1], row[2] + row[3]) for row in traffic_history.daily(sub.id, BURN_RATE_DAYS + 1, now)]
+
+    pages = format_history_report(sub, daily, rate_samples, now)
+    text, markup = paginate_report(update.effective_chat.id, pages, 'HTML')
+    await send_message(context, text, update.effective_chat.id, reply_markup=markup)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /stats 命令，显示运行状态"""
+    if not await admin_required(update, context):
+        return
+
+    io_stats = io_executor.stats()
+    cache_stats = userinfo_cache.stats()
+    history_stats = traffic_history.stats()
+    send_totals = message_dispatcher.totals()
+    processor = context.application.update_processor
+    commands = "，".join(
+        f"/{command} {processor.command_running[command]}/{limit}" for command, limit in processor.limits.items()
+    )
+    text = (
+        "运行状态：\n\n"
+        "网络请求线程池：\n"
+        f"线程数：{io_stats['max_workers']}\n"
+        f"执行中：{io_stats['in_flight']}\n"
+        f"排队中：{io_stats['queued']}（峰值 {io_stats['peak_queued']}）\n"
+        f"已完成：{io_stats['completed']}（失败 {io_stats['failed']}）\n\n"
+        "订阅请求传输：\n"
+        f"{transfer_stats.summary()}\n\n"
+        "流量信息缓存：\n"
+        f"条目：{cache_stats['entries']}\n"
+        f"命中：{cache_stats['hits']}，未命中：{cache_stats['misses']}，条件请求复用：{cache_stats['revalidated']}\n"
+        f"合并请求：发起 {userinfo_flights.started} 次，共享 {userinfo_flights.coalesced} 次\n"
+        f"已缓存永久重定向：{len(redirect_cache)} 条\n"
+        f"机场名缓存：{len(airport_names)} 个主机（命中 {airport_names.hits}，未命中 {airport_names.misses}）\n\n"
+        "流量历史：\n"
+        f"小时样本：{history_stats['hourly']} 条，每日样本：{history_stats['daily']} 条\n\n"
+        "流量告警：\n"
+        f"已发送：{alert_engine.fired} 条，当前处于告警状态：{alert_engine.active()} 项\n\n"
+        "后台检查：\n"
+        f"{'已启用' if SCHEDULE_ENABLED else '未启用'}，已检查 {check_scheduler.checked} 次\n\n"
+        "更新处理：\n"
+        f"执行中：{processor.running}/{processor.workers}，等待中：{processor.waiting}，已处理：{processor.processed}\n"
+        f"耗时命令（执行中/上限）：{commands or '不限制'}\n\n"
+        "消息发送：\n"
+        f"成功 {send_totals['sent']}，失败 {send_totals['failed']}，重试 {send_totals['retried']}，被限流 {send_totals['limited']}\n"
+        f"待删除消息：{len(deletion_queue)} 条（已删除 {deletion_queue.deleted}，失败 {deletion_queue.failed}）\n"
+    )
+    # 按聊天列出发送情况，失败多的在前
+    chats = sorted(message_dispatcher.metrics.items(), key=lambda item: (-item[1]['failed'], -item[1]['sent']))
+    for chat_id, metric in chats[:20]:
+        text += (f"{escape_html(chat_id)}：成功 {metric['sent']}，失败 {metric['failed']}，"
+                 f"重试 {metric['retried']}，限流 {metric['limited']}")
+        if metric['error']:
+            text += f"，最近错误：{escape_html(metric['error'][:80])}"
+        text += "\n"
     await send_message(context, text, update.effective_chat.id)
 
 async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -963,40 +3068,11 @@ async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             success_msg += f"新备注：{escape_html(new_message)}"
         await send_message(context, success_msg, update.effective_chat.id)
     else:
-        if new_name and any(sub['name'] == new_name for sub in subscription_manager.subscriptions):
+        if new_name and subscription_manager.get_subscription(new_name) is not None:
             await send_message(context, f"订阅名称 {escape_html(new_name)} 已存在！", update.effective_chat.id)
         else:
             await send_message(context, f"订阅 {escape_html(old_name)} 不存在！", update.effective_chat.id)
 
-def check_and_install_requirements():
-    """检查并安装必要的依赖"""
-    requirements = {
-        'python-telegram-bot': 'telegram',
-        'requests': 'requests',
-        'beautifulsoup4': 'bs4'
-    }
-    
-    missing_packages = []
-    for package, import_name in requirements.items():
-        try:
-            __import__(import_name)
-        except ImportError:
-            missing_packages.append(package)
-    
-    if missing_packages:
-        logging.info(f"正在安装缺失的依赖: {', '.join(missing_packages)}")
-        try:
-            subprocess.check_call([sys.executable, "-m", "pip", "install", *missing_packages])
-            logging.info("依赖安装完成")
-        except Exception as e:
-            logging.error(f"安装依赖失败: {str(e)}")
-            sys.exit(1)
-    else:
-        logging.info("所有依赖已安装")
-
-# 检查并安装依赖
-check_and_install_requirements()
-
 def escape_markdown(text):
     """转义 MarkdownV2 特殊字符"""
     special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
@@ -1004,56 +3080,134 @@ def escape_markdown(text):
         text = text.replace(char, f'\\{char}')
     return text
 
+PANEL_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (HTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
+}
+TITLE_PATTERN = re.compile(rb'<title[^>]*>(.*?)</title', re.I | re.S)
+CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+CONVERTER_URL_PATTERN = re.compile(r"sub\?target=.*?[?&]url=([^&]*)")
+FILENAME_PATTERN = re.compile(r"filename\*=UTF-8''(.+)")
+# 拦截页和非面板页面的标题 -> 显示的说明
+KNOWN_TITLES = {
+    "Attention Required! | Cloudflare": '该域名仅限国内IP访问',
+    "Access denied": '该域名非机场面板域名',
+    "404 Not Found": '该域名非机场面板域名',
+    "Just a moment": '该域名开启了5s盾',
+}
+KNOWN_TITLE_PATTERN = re.compile("|".join(map(re.escape, KNOWN_TITLES)))
+
+def read_title(res: requests.Response):
+    """流式读取 HTML 直到 </title>，返回标题文本，读取 TITLE_READ_LIMIT 字节仍未找到时返回 None"""
+    buffer = bytearray()
+    try:
+        for chunk in res.iter_content(4096):
+            buffer += chunk
+            match = TITLE_PATTERN.search(buffer)
+            if match:
+                break
+            if len(buffer) >= TITLE_READ_LIMIT:
+                return None
+        else:
+            return None
+    finally:
+        res.close()
+    # 响应头未声明编码时，使用 <title> 之前 <meta> 中声明的编码
+    encoding = 'utf-8'
+    if 'charset=' in res.headers.get('Content-Type', ''):
+        encoding = res.encoding
+    else:
+        meta = CHARSET_PATTERN.search(buffer, 0, match.start())
+        if meta:
+            encoding = meta.group(1).decode('ascii')
+    try:
+        title = match.group(1).decode(encoding, errors='replace')
+    except LookupError:
+        title = match.group(1).decode('utf-8', errors='replace')
+    return html.unescape(title).strip()
+
+def unwrap_converter_url(url: str) -> str:
+    """订阅转换链接（sub?target=...&url=...）返回其中的原始订阅链接"""
+    match = CONVERTER_URL_PATTERN.search(url)
+    while match:
+        url = unquote(match.group(1))
+        match = CONVERTER_URL_PATTERN.search(url)
+    return url
+
 def get_filename_from_url(url):
-    if "sub?target=" in url:
-        pattern = r"url=([^&]*)"
-        match = re.search(pattern, url)
-        if match:
-            encoded_url = match.group(1)
-            decoded_url = unquote(encoded_url)
-            return get_filename_from_url(decoded_url)
-    elif "api/v1/client/subscribe?token" in url:
+    """请求面板获取机场名：V2Board 订阅取 Content-Disposition 中的文件名，其余取登录页或首页的标题"""
+    if "api/v1/client/subscribe?token" in url:
         if "&flag=clash" not in url:
             url = url + "&flag=clash"
         try:
-            response = requests.get(url)
+            # 只需要响应头，不下载节点列表
+            response = http_request(http_session, 'GET', url, retries=0, stream=True)
+            response.close()
             header = response.headers.get('Content-Disposition')
-            if header:
-                pattern = r"filename\*=UTF-8''(.+)"
-                result = re.search(pattern, header)
-                if result:
-                    filename = result.group(1)
-                    filename = unquote(filename)
-                    airport_name = filename.replace("%20", " ").replace("%2B", "+")
-                    return airport_name
-        except:
+            result = FILENAME_PATTERN.search(header) if header else None
+            if result:
+                return unquote(result.group(1)).replace("%20", " ").replace("%2B", "+")
+        except Exception:
             return '未知'
-    else:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (HTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
-        }
-        try:
-            pattern = r'(https?://)([^/]+)'
-            match = re.search(pattern, url)
-            base_url = None
-            if match:
-                base_url = match.group(1) + match.group(2)
-            response = requests.get(url=base_url + '/auth/login', headers=headers, timeout=10)
-            if response.status_code != 200:
-                response = requests.get(base_url, headers=headers, timeout=1)
-            html = response.content
-            soup = BeautifulSoup(html, 'html.parser')
-            title = soup.title.string
-            title = str(title).replace('登录 — ', '')
-            if "Attention Required! | Cloudflare" in title:
-                title = '该域名仅限国内IP访问'
-            elif "Access denied" in title or "404 Not Found" in title:
-                title = '该域名非机场面板域名'
-            elif "Just a moment" in title:
-                title = '该域名开启了5s盾'
-            return title
-        except:
+    try:
+        parsed = urlparse(url)
+        base_url = f"{parsed.scheme}://{parsed.netloc}"
+        response = http_request(http_session, 'GET', base_url + '/auth/login', retries=0,
+                                headers=PANEL_HEADERS, timeout=10, stream=True)
+        if response.status_code != 200:
+            response.close()
+            response = http_request(http_session, 'GET', base_url, retries=0,
+                                    headers=PANEL_HEADERS, timeout=1, stream=True)
+        title = read_title(response)
+        if title is None:
             return '未知'
+        title = title.replace('登录 — ', '')
+        known = KNOWN_TITLE_PATTERN.search(title)
+        return KNOWN_TITLES[known.group(0)] if known else title
+    except Exception:
+        return '未知'
+
+class AirportNameCache:
+    """按主机缓存机场名，未能解析的主机在 NAME_RETRY_TTL 后重新请求"""
+
+    def __init__(self):
+        self._entries = OrderedDict()  # host -> (过期时间, 机场名)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, host: str):
+        entry = self._entries.get(host)
+        if entry is not None and entry[0] > time.time():
+            self._entries.move_to_end(host)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, host: str, name: str):
+        ttl = NAME_RETRY_TTL if name == '未知' else NAME_CACHE_TTL
+        self._entries[host] = (time.time() + ttl, name)
+        self._entries.move_to_end(host)
+        while len(self._entries) > CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+airport_names = AirportNameCache()
+airport_name_flights = SingleFlight()
+
+async def resolve_airport_name(url: str) -> str:
+    """返回订阅链接对应的机场名：依次查找 panel_names 配置和缓存，
+    否则在 io_executor 中请求面板，同一主机的并发请求只发出一次"""
+    url = unwrap_converter_url(url)
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    name = PANEL_NAMES.get((parsed.hostname or '').lower()) or airport_names.get(host)
+    if name:
+        return name
+    name = await airport_name_flights.do(host, lambda: io_executor.run(get_filename_from_url, url))
+    airport_names.put(host, name)
+    return name
 
 def convert_time_to_str(ts):
     return str(ts).zfill(2)
@@ -1085,26 +3239,130 @@ def StrOfSize(size):
     return ('{}.{:>03d} {}'.format(integer, remainder, units[level]))
 
 # ------------------ 主函数 ------------------
+class StartupTimer:
+    """记录启动各阶段的耗时，启动完成后写入日志"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.phases = []
+        self.done = False
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def summary(self) -> str:
+        phases = "，".join(f"{phase} {elapsed * 1000:.0f}ms" for phase, elapsed in self.phases)
+        return f"启动耗时 {(self._last - self.started) * 1000:.0f}ms：{phases}"
+
+startup_timer = StartupTimer(IMPORT_STARTED)
+
+def init_services():
+    """按配置创建网络、存储和消息相关的全局对象，在 apply_config() 之后调用"""
+    global http_session, io_executor, subscription_manager, traffic_history, alert_engine
+    global check_scheduler, message_dispatcher, deletion_queue
+    if DNS_CACHE_TTL > 0:
+        socket.getaddrinfo = _getaddrinfo_cached
+    http_session = create_http_session()
+    io_executor = IOExecutor(IO_WORKERS)
+    message_dispatcher = MessageDispatcher(SEND_CONCURRENCY, SEND_RATE)
+    subscription_manager = SubscriptionManager()
+    # 流量历史、告警、调度和删除队列的表与订阅放在同一个数据库，共用一个连接
+    traffic_history = TrafficHistory(subscription_manager.store)
+    alert_engine = AlertEngine(subscription_manager.store)
+    check_scheduler = CheckScheduler(subscription_manager.store)
+    deletion_queue = DeletionQueue(subscription_manager.store)
+
+async def post_init(application: Application):
+    """开始接收消息前调用：记录启动耗时并发送启动通知（webhook 回退到轮询时不重复）"""
+    if startup_timer.done:
+        return
+    startup_timer.done = True
+    startup_timer.mark("连接 Telegram")
+    logging.info(startup_timer.summary())
+    await send_startup_notification(application)
+
+def webhook_available() -> bool:
+    """webhook 模式需要 python-telegram-bot[webhooks]（tornado），未安装时使用轮询"""
+    if not WEBHOOK_URL:
+        return False
+    try:
+        import tornado  # noqa: F401
+    except ImportError:
+        logging.warning('已配置 webhook_url 但未安装 webhook 依赖（pip install "python-telegram-bot[webhooks]==20.7"），改用轮询模式')
+        return False
+    return True
+
+def run_application(application: Application, use_webhook: bool):
+    """以 webhook 模式运行，启动失败时清理后回退到轮询模式"""
+    if use_webhook:
+        url_path = urlparse(WEBHOOK_URL).path.strip('/')
+        started = []
+
+        async def mark_started(_):
+            # 定时任务在应用启动成功后才会执行，据此区分启动失败和运行后停止
+            started.append(True)
+
+        application.job_queue.run_once(mark_started, 0, name="webhook_started")
+        try:
+            logging.info(f"使用 webhook 模式，监听 {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=url_path,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                close_loop=False  # 回退到轮询时继续使用同一个事件循环
+            )
+            return
+        except Exception as e:
+            if started:
+                logging.error(f"webhook 模式停止时出错: {str(e)}")
+                return
+            logging.error(f"webhook 模式启动失败，改用轮询模式: {str(e)}")
+    # 轮询开始时会删除已设置的 webhook
+    application.run_polling()
+
 async def send_startup_notification(context: ContextTypes.DEFAULT_TYPE):
     """发送机器人启动通知"""
-    if CHAT_IDS:
-        for chat_id in CHAT_IDS:
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text="🤖 订阅管理机器人已启动\n\n"
-                         "📝 可用命令：\n"
-                         "/help - 查看帮助信息\n"
-                         "/sub - 检查订阅链接\n"
-                         "/check - 检查所有订阅状态"
-                )
-            except Exception as e:
-                logging.error(f"发送启动通知到群组 {chat_id} 失败: {str(e)}")
+    text = (
+        "🤖 订阅管理机器人已启动\n\n"
+        "📝 可用命令：\n"
+        "/help - 查看帮助信息\n"
+        "/sub - 检查订阅链接\n"
+        "/check - 检查所有订阅状态"
+    )
+    results = await message_dispatcher.fan_out(
+        CHAT_IDS, lambda chat_id: message_dispatcher.send(context.bot, chat_id, text)
+    )
+    for chat_id, result in zip(CHAT_IDS, results):
+        if isinstance(result, Exception):
+            logging.error(f"发送启动通知到群组 {chat_id} 失败: {str(result)}")
 
 def main():
+    setup_logging()
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
-        application.job_queue.scheduler.configure(timezone=TIMEZONE)
+        startup_timer.mark("导入模块")
+        apply_config(load_config())
+        startup_timer.mark("读取配置")
+        init_services()
+        startup_timer.mark(f"加载 {len(subscription_manager)} 个订阅和存储")
+
+        use_webhook = webhook_available()
+        # 不同聊天的更新并发处理，同一聊天内保持顺序
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(ChatOrderedProcessor(UPDATE_WORKERS, COMMAND_LIMITS))
+            .build()
+        )
+        # configure() 会覆盖 JobQueue 自带的执行器，需要一并传入，否则停止时出错
+        application.job_queue.scheduler.configure(
+            **{**application.job_queue.scheduler_configuration, "timezone": TIMEZONE}
+        )
 
         # 命令处理器
         application.add_handler(CommandHandler("start", start_command))
@@ -1121,19 +3379,37 @@ def main():
         application.add_handler(CommandHandler("addgroup", add_group_command))
         application.add_handler(CommandHandler("removegroup", remove_group_command))
         application.add_handler(CommandHandler("listgroups", list_groups_command))
+        application.add_handler(CommandHandler("stats", stats_command))
+        application.add_handler(CommandHandler("import", import_command))
+        application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"), import_command))
+        application.add_handler(CommandHandler("export", export_command))
+        application.add_handler(CommandHandler("history", history_command))
+        application.add_handler(CommandHandler("alert", alert_command))
+        application.add_handler(CommandHandler("schedule", schedule_command))
+        application.add_handler(CallbackQueryHandler(page_callback, pattern=r"^page:"))
 
         # 设置定时任务
-        application.job_queue.run_daily(
-            check_command,
-            time=dtime(hour=config.get("check_hour", 9), tzinfo=TIMEZONE),
-            name="daily_check"
+        schedule_daily_check(application.job_queue, config.get("check_hour", 9))
+        application.job_queue.run_repeating(
+            deletion_queue.drain,
+            interval=DELETE_TICK,
+            first=1,
+            name="delete_messages"
         )
+        if SCHEDULE_ENABLED:
+            application.job_queue.run_repeating(
+                check_scheduler.tick,
+                interval=SCHEDULE_TICK,
+                first=SCHEDULE_TICK,
+                name="adaptive_check"
+            )
 
         # 添加启动通知
-        application.post_init = send_startup_notification
+        application.post_init = post_init
+        startup_timer.mark("注册命令和定时任务")
 
         logging.info("机器人已启动")
-        application.run_polling()
+        run_application(application, use_webhook)
 
     except Exception as e:
         logging.error(f"启动机器人时出错: {str(e)}")
@@ -0,0 +1,128 @@
+"""本地模拟的 Telegram Bot API，以及按录制的更新生成回放数据，供 webhook/轮询测试和压测使用"""
+import copy
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+
+UPDATES_FILE = Path(__file__).with_name('fixtures') / 'updates.json'
+BOT_USERNAME = 'subscription_test_bot'
+
+
+def load_updates(count: int = None) -> list:
+    """读取录制的更新；指定 count 时循环复制到 count 条，每一轮换用新的聊天，update_id 连续编号"""
+    recorded = json.loads(UPDATES_FILE.read_text(encoding='utf-8'))
+    if count is None:
+        return recorded
+    updates = []
+    for i in range(count):
+        update = copy.deepcopy(recorded[i % len(recorded)])
+        round_ = i // len(recorded)
+        update['update_id'] = i + 1
+        for key in ('message', 'edited_message'):
+            if key in update:
+                message = update[key]
+                message['message_id'] = i + 1
+                chat = message['chat']
+                # 私聊 id 为正数、群组为负数，每一轮向远离 0 的方向偏移
+                chat['id'] += round_ * 100000 if chat['id'] > 0 else -round_ * 100000
+                if chat['type'] == 'private':
+                    message['from']['id'] = chat['id']
+        updates.append(update)
+    return updates
+
+
+def expected_replies(updates: list) -> int:
+    """机器人会回复的更新数：每条 /help 命令回复一条消息，其余更新不回复"""
+    return sum(1 for update in updates if update.get('message', {}).get('text', '').startswith('/help'))
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        api = self.server.api
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        api.record(method, params)
+
+        if method == 'setWebhook' and api.fail_set_webhook:
+            self.reply(400, {"ok": False, "error_code": 400, "description": "Bad Request: bad webhook"})
+            return
+        self.reply(200, {"ok": True, "result": api.result(method, params)})
+
+    def reply(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeBotAPI:
+    """在本地线程中运行的 Bot API：记录每次调用，getUpdates 按 offset 返回 updates 中排队的更新"""
+
+    def __init__(self, fail_set_webhook: bool = False, send_delay: float = 0):
+        self.fail_set_webhook = fail_set_webhook
+        self.send_delay = send_delay
+        self.updates = []
+        self.calls = []  # (方法名, 参数)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPIHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/bot"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def record(self, method: str, params: dict):
+        with self._lock:
+            self.calls.append((method, params))
+
+    def count(self, method: str) -> int:
+        with self._lock:
+            return sum(1 for name, _ in self.calls if name == method)
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {"id": 123, "is_bot": True, "first_name": "bot", "username": BOT_USERNAME,
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == 'sendMessage':
+            time.sleep(self.send_delay)
+            chat_id = int(params['chat_id'])
+            return {"message_id": self.count(method), "date": int(time.time()), "text": params.get('text', ''),
+                    "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or 100)
+            pending = [update for update in self.updates if update['update_id'] >= offset][:limit]
+            if not pending:
+                # 长轮询：没有新更新时稍等再返回空列表
+                time.sleep(0.2)
+            return pending
+        return True
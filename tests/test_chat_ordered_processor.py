@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+from telegram import Update
+
+import subscription_bot as sb
+
+
+def make_update(update_id, chat_id, text):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1790000000,
+            "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+        },
+    }, None)
+
+
+async def start(workers, limits=None):
+    processor = sb.ChatOrderedProcessor(workers, limits or {})
+    await processor.initialize()
+    return processor
+
+
+def test_same_chat_updates_run_in_order():
+    events = []
+
+    async def handle(index, delay):
+        events.append(('start', index))
+        await asyncio.sleep(delay)
+        events.append(('end', index))
+
+    async def main():
+        processor = await start(4)
+        # 先到的更新耗时更长，若并发执行则后到的会先结束
+        await asyncio.gather(*(processor.process_update(make_update(i, 1, '/help'), handle(i, 0.05 - i * 0.01))
+                               for i in range(5)))
+
+    asyncio.run(main())
+    assert events == [(kind, i) for i in range(5) for kind in ('start', 'end')]
+
+
+def test_different_chats_overlap():
+    running = peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.2)
+        running -= 1
+
+    async def main():
+        processor = await start(4)
+        started = time.monotonic()
+        await asyncio.gather(*(processor.process_update(make_update(i, 100 + i, '/help'), handle())
+                               for i in range(8)))
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(main())
+    assert peak == 4
+    assert elapsed < 0.6
+
+
+def test_capped_command_waits_without_holding_a_worker():
+    async def main():
+        processor = await start(2, {"check": 1})
+        release = asyncio.Event()
+        order = []
+
+        async def check(name):
+            order.append(f'{name} start')
+            await release.wait()
+            order.append(f'{name} end')
+
+        async def help_():
+            order.append('help')
+
+        first = asyncio.ensure_future(processor.process_update(make_update(1, 1, '/check'), check('a')))
+        await asyncio.sleep(0.05)
+        second = asyncio.ensure_future(processor.process_update(make_update(2, 2, '/check@bot all'), check('b')))
+        await asyncio.sleep(0.05)
+        # 两个工作名额：一个被运行中的 /check 占用，排队的 /check 不占用，/help 可以立即执行
+        assert (processor.running, processor.waiting, processor.command_running) == (1, 1, {"check": 1})
+        await asyncio.wait_for(processor.process_update(make_update(3, 3, '/help'), help_()), 1)
+        assert order == ['a start', 'help']
+
+        release.set()
+        await asyncio.gather(first, second)
+        assert order == ['a start', 'help', 'a end', 'b start', 'b end']
+        assert (processor.running, processor.waiting, processor.processed) == (0, 0, 3)
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiting_update_closes_its_coroutine():
+    async def main():
+        processor = await start(1)
+        release = asyncio.Event()
+        ran = []
+
+        async def blocker():
+            await release.wait()
+
+        async def handle():
+            ran.append(True)
+
+        coroutine = handle()
+        first = asyncio.ensure_future(processor.process_update(make_update(1, 1, '/help'), blocker()))
+        waiting = asyncio.ensure_future(processor.process_update(make_update(2, 1, '/help'), coroutine))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        release.set()
+        await first
+        # 协程已关闭而不是遗留为 "never awaited"，同一聊天之后的更新照常处理
+        assert coroutine.cr_frame is None and not ran
+        await processor.process_update(make_update(3, 1, '/help'), handle())
+        assert ran == [True]
+        assert (processor.running, processor.waiting) == (0, 0)
+
+    asyncio.run(main())
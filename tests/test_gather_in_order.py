@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import subscription_bot as sb
+
+
+class StubState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.release = threading.Event()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """返回 subscription-userinfo 头的订阅接口，按 delay 参数延迟响应"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        state = self.server.state
+        query = parse_qs(urlparse(self.path).query)
+        with state.lock:
+            state.active += 1
+            state.peak = max(state.peak, state.active)
+        try:
+            state.release.wait(float(query['delay'][0]))
+        finally:
+            with state.lock:
+                state.active -= 1
+        self.send_response(200)
+        self.send_header('subscription-userinfo', f"upload={query['id'][0]}; download=0; total=100; expire=0")
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.state.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def boot(tmp_path, monkeypatch, **cfg):
+    monkeypatch.chdir(tmp_path)
+    sb.apply_config({
+        "bot_token": "123:abc",
+        "subscriptions_db": str(tmp_path / "subscriptions.db"),
+        "dns_cache_ttl": 0,
+        "fetch_retries": 0,
+        **cfg
+    })
+    sb.init_services()
+
+
+def urls(server, delays):
+    port = server.server_address[1]
+    return [f"http://127.0.0.1:{port}/sub?id={i}&delay={delay}" for i, delay in enumerate(delays)]
+
+
+def fetch(url):
+    return sb.io_executor.run(sb.fetch_userinfo, url, None, True)
+
+
+def test_results_keep_input_order(stub, tmp_path, monkeypatch):
+    boot(tmp_path, monkeypatch, fetch_concurrency=8)
+    # 越靠后的链接响应越快，完成顺序与输入顺序相反
+    items = urls(stub, [0.4, 0.3, 0.2, 0.1, 0])
+    completed = []
+    results = asyncio.run(sb.gather_in_order(fetch, items, on_result=lambda index, _: completed.append(index)))
+    assert [result['traffic'].upload for result in results] == [0, 1, 2, 3, 4]
+    assert completed == [4, 3, 2, 1, 0]
+
+
+def test_concurrency_limit(stub, tmp_path, monkeypatch):
+    boot(tmp_path, monkeypatch, fetch_concurrency=3)
+    results = asyncio.run(sb.gather_in_order(fetch, urls(stub, [0.2] * 9)))
+    assert all(result['status_code'] == 200 for result in results)
+    assert stub.state.peak == 3
+
+
+def test_deadline_marks_unfinished_items(stub, tmp_path, monkeypatch):
+    boot(tmp_path, monkeypatch, fetch_concurrency=4, check_deadline=0.5)
+    started = time.monotonic()
+    results = asyncio.run(sb.gather_in_order(fetch, urls(stub, [0, 5, 0.1, 5])))
+    assert time.monotonic() - started < 2
+    assert results[0]['traffic'].upload == 0
+    assert results[2]['traffic'].upload == 2
+    assert isinstance(results[1], asyncio.TimeoutError)
+    assert isinstance(results[3], asyncio.TimeoutError)
@@ -0,0 +1,127 @@
+import base64
+import io
+
+import pytest
+import requests
+
+import subscription_bot as sb
+
+CHUNK_SIZES = [1, 3, 7, 64, 1000, 4097, sb.NODE_SCAN_CHUNK]
+INFO = ["upload=1073741824", "download=5368709120", "total=107374182400", "expire=1767196800"]
+INFO_VALUES = {'upload': 1073741824, 'download': 5368709120, 'total': 107374182400, 'expire': 1767196800}
+
+
+def ss_nodes(count):
+    return [f"ss://{base64.b64encode(b'aes-256-gcm:pw%d' % i).decode()}@1.2.3.{i % 250}:{10000 + i}#HK%20{i:04d}"
+            for i in range(count)]
+
+
+def vmess_nodes(count):
+    # 节点名含中文和 emoji，整体 base64 编码后含有 + 和 /，可检验 URL 安全字符的转换
+    return ["vmess://" + base64.b64encode(bytes((i * 7 + j) % 256 for j in range(48))).decode() + f"#🇭🇰 香港 {i:04d}"
+            for i in range(count)]
+
+
+def b64(lines, wrap=False, urlsafe=False, pad=True):
+    data = base64.b64encode("\n".join(lines).encode())
+    if urlsafe:
+        data = data.translate(bytes.maketrans(b'+/', b'-_'))
+    if not pad:
+        data = data.rstrip(b'=')
+    if wrap:
+        data = b"\r\n".join(data[i:i + 76] for i in range(0, len(data), 76))
+    return data
+
+
+def scan(body, size):
+    scanner = sb.NodeListScanner()
+    for i in range(0, len(body), size):
+        if scanner.feed(body[i:i + size]):
+            break
+    else:
+        scanner.finish()
+    return scanner
+
+
+BODIES = {
+    # 4262719 的回归：只含 base64 字符的明文不能按 base64 解码
+    "plain key=value lines": (b"upload=1024\ndownload=2048\ntotal=107374182400\n",
+                              {'upload': 1024, 'download': 2048, 'total': 107374182400}),
+    "plain one line": (("upload=1; download=2; total=3; expire=4\n" + "\n".join(ss_nodes(200))).encode(),
+                       {'upload': 1, 'download': 2, 'total': 3, 'expire': 4}),
+    "plain info after nodes": ("\n".join(vmess_nodes(500) + INFO)).encode(),
+    "base64": b64(INFO + ss_nodes(200)),
+    "base64 info after nodes": b64(vmess_nodes(500) + INFO),
+    "base64 url-safe unpadded": b64(vmess_nodes(300) + INFO, urlsafe=True, pad=False),
+    "base64 wrapped": b64(INFO + vmess_nodes(300), wrap=True),
+    "base64 url-safe wrapped": b64(vmess_nodes(300) + INFO, wrap=True, urlsafe=True, pad=False),
+    "short base64": (b64(["total=100"]), {'total': 100}),
+    "colon keys": (b64(["UPLOAD: 11", "Download: 22", "total:33", "expire :44"] + ss_nodes(50)),
+                   {'upload': 11, 'download': 22, 'total': 33, 'expire': 44}),
+    # 日期不是时间戳，不作为到期时间
+    "总流量 and expire date": (b64(["总流量：500", "Expire: 2025-01-01"] + ss_nodes(50)), {'total': 500}),
+    # 每个字段取第一次出现的值
+    "first occurrence wins": (b"total=5\n" + "\n".join(ss_nodes(100)).encode() + b"\ntotal=9\nupload=1\n",
+                              {'total': 5, 'upload': 1}),
+}
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("name", BODIES)
+def test_info_does_not_depend_on_chunking(name, size):
+    body, expected = BODIES[name] if isinstance(BODIES[name], tuple) else (BODIES[name], INFO_VALUES)
+    assert scan(body, size).info == expected
+
+
+def test_url_safe_corpus_uses_url_safe_characters():
+    body = BODIES["base64 url-safe unpadded"]
+    assert b'-' in body and b'_' in body and not body.endswith(b'=')
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("body", [b"\n".join(line.encode() for line in ss_nodes(3) + vmess_nodes(3)),
+                                  b64(vmess_nodes(3) + ss_nodes(3))])
+def test_ss_link_is_first_ss_line(body, size):
+    scanner = scan(body, size)
+    assert scanner.info == {}
+    assert scanner.ss_link == ss_nodes(1)[0]
+
+
+def test_plain_body_is_not_decoded_as_base64():
+    scanner = scan(BODIES["plain key=value lines"][0], sb.NODE_SCAN_CHUNK)
+    assert scanner._base64 is False
+
+
+def test_undecodable_chunk_is_scanned_as_plain_text():
+    # 开头像 base64，后面出现无法解码的内容：按明文扫描原始块，换行不能被去掉
+    body = b64(vmess_nodes(100)) + b"\nab=c\nupload=12\ndownload=3\n"
+    assert scan(body, len(body)).info == {'upload': 12, 'download': 3}
+
+
+def response(body, content_length=None):
+    res = requests.Response()
+    res.status_code = 200
+    res.raw = io.BytesIO(body)
+    if content_length is not None:
+        res.headers['Content-Length'] = content_length
+    return res
+
+
+@pytest.mark.parametrize("content_length", [None, "", "abc"])
+def test_scan_body_stops_once_all_fields_are_found(content_length):
+    body = b64(INFO + vmess_nodes(5000))
+    stats = sb.TransferStats()
+    length = str(len(body)) if content_length is None else content_length
+    scanner = sb.NodeListScanner()
+    sb.scan_body(response(body, length), scanner, stats)
+    assert scanner.info == INFO_VALUES
+    assert stats.bytes_received == sb.NODE_SCAN_CHUNK
+    # Content-Length 缺失或格式错误时不估算跳过的字节数
+    assert stats.bytes_skipped == (len(body) - sb.NODE_SCAN_CHUNK if content_length is None else 0)
+
+
+def test_traffic_from_body():
+    traffic = sb.traffic_from_body('http://127.0.0.1/sub', response(b64(INFO + vmess_nodes(10))), sb.TransferStats())
+    assert (traffic.upload, traffic.download, traffic.total, traffic.expire) == (
+        1073741824, 5368709120, 107374182400, 1767196800)
+    assert sb.traffic_from_body('http://127.0.0.1/sub', response(b64(vmess_nodes(10))), sb.TransferStats()) is None
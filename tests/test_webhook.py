@@ -0,0 +1,50 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+HARNESS = Path(__file__).with_name('webhook_harness.py')
+
+
+def run_harness(tmp_path, mode, *args):
+    # main() 按信号停止，且会写入当前目录，在独立进程和临时目录中运行
+    proc = subprocess.run([sys.executable, str(HARNESS), mode, *args], cwd=tmp_path,
+                          capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr[-4000:]
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def test_polling_replays_recorded_updates(tmp_path):
+    summary = run_harness(tmp_path, 'polling')
+    assert summary['replies'] == summary['expected_replies'] > 0
+    assert summary['setWebhook'] == 0
+    assert summary['getUpdates'] > 0
+
+
+def test_missing_tornado_falls_back_to_polling(tmp_path):
+    summary = run_harness(tmp_path, 'no-tornado')
+    assert summary['setWebhook'] == 0
+    assert summary['getUpdates'] > 0
+    assert summary['replies'] == summary['expected_replies']
+
+
+def test_webhook_checks_secret_and_handles_updates(tmp_path):
+    pytest.importorskip('tornado')
+    summary = run_harness(tmp_path, 'webhook')
+    assert summary['wrong_secret'] == 403
+    assert summary['missing_secret'] == 403
+    assert summary['statuses'] == [200]
+    assert summary['replies'] == summary['expected_replies']
+    assert summary['getUpdates'] == 0
+
+
+def test_failed_set_webhook_falls_back_to_polling(tmp_path):
+    pytest.importorskip('tornado')
+    summary = run_harness(tmp_path, 'fail-set-webhook')
+    assert summary['setWebhook'] >= 1
+    # 轮询开始时删除 webhook
+    assert summary['deleteWebhook'] >= 1
+    assert summary['getUpdates'] > 0
+    assert summary['replies'] == summary['expected_replies']
@@ -0,0 +1,117 @@
+"""回放录制的更新驱动完整的机器人进程（main()），在最后一行输出 JSON 格式的统计
+
+用法（在一个空的临时目录中运行，会写入 config.json 和数据库）：
+    python tests/webhook_harness.py webhook|polling|fail-set-webhook|no-tornado [--updates N] [--clients C]
+
+webhook：先用错误和缺失的 secret 各请求一次，再由 C 个客户端并发推送 N 条更新；
+polling：由模拟 API 的 getUpdates 返回 N 条更新；
+fail-set-webhook：配置了 webhook 但 setWebhook 失败，应回退到轮询并处理所有更新；
+no-tornado：配置了 webhook 但无法导入 tornado，应直接使用轮询。
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_bot_api import FakeBotAPI, expected_replies, load_updates  # noqa: E402
+
+SECRET = 's3cret'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def post(url: str, update: dict, secret: str) -> int:
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def replies(api: FakeBotAPI) -> int:
+    # 不计入管理员和群组的启动通知
+    return api.count('sendMessage')
+
+
+def drive(api: FakeBotAPI, args, hook_url: str, hook_port: int, summary: dict):
+    updates = load_updates(args.updates)
+    expected = expected_replies(updates)
+    summary['expected_replies'] = expected
+    started = time.perf_counter()
+    try:
+        if args.mode == 'webhook':
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', hook_port), 0.2).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            summary['wrong_secret'] = post(hook_url, updates[0], 'wrong')
+            summary['missing_secret'] = post(hook_url, updates[0], '')
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as executor:
+                statuses = list(executor.map(lambda update: post(hook_url, update, SECRET), updates))
+            summary['posted_seconds'] = round(time.perf_counter() - started, 3)
+            summary['statuses'] = sorted(set(statuses))
+        else:
+            api.updates = updates
+        deadline = time.monotonic() + args.timeout
+        while replies(api) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+        summary['seconds'] = round(time.perf_counter() - started, 3)
+    finally:
+        os.kill(os.getpid(), signal.SIGINT)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=['webhook', 'polling', 'fail-set-webhook', 'no-tornado'])
+    parser.add_argument('--updates', type=int, default=60, help='回放的更新数量')
+    parser.add_argument('--clients', type=int, default=20, help='webhook 模式下并发推送的客户端数量')
+    parser.add_argument('--timeout', type=float, default=30, help='等待所有回复的最长秒数')
+    args = parser.parse_args()
+
+    if args.mode == 'no-tornado':
+        sys.modules['tornado'] = None  # 使 import tornado 抛出 ImportError
+
+    hook_port = free_port()
+    hook_url = f"http://127.0.0.1:{hook_port}/hook"
+    config = {"bot_token": "123:abc", "chat_ids": [], "admin_id": "1"}
+    if args.mode != 'polling':
+        config.update(webhook_url=hook_url, webhook_listen='127.0.0.1', webhook_port=hook_port, webhook_secret=SECRET)
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+    import subscription_bot as sb
+    api = FakeBotAPI(fail_set_webhook=args.mode == 'fail-set-webhook').start()
+    builder = sb.Application.builder
+    sb.Application.builder = staticmethod(lambda: builder().base_url(api.base_url))
+
+    summary = {'mode': args.mode}
+    threading.Thread(target=drive, args=(api, args, hook_url, hook_port, summary), daemon=True).start()
+    sb.main()
+    api.stop()
+    summary['replies'] = replies(api)
+    for method in ('setWebhook', 'deleteWebhook', 'getUpdates'):
+        summary[method] = api.count(method)
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()